@@ -14,6 +14,7 @@ a plot from data within an h5 file.
 import os
 import sys
 import ast
+import collections
 
 import h5py
 import h5py._hl.dataset 
@@ -25,6 +26,60 @@ import numpy
 #
 # -----------------------------------------------------------------------------
 
+def _write_attribute(attrs, name, value):
+    """
+    Sets the attribute name of the AttributeManager attrs to value, leaving
+    it alone if it already has this value, and writing it in place if it
+    already has the same shape and type: a variable length string, or an
+    identical numeric dtype.  This avoids leaving behind the unreclaimed
+    space of a deleted attribute every time an object is saved again.
+    Otherwise it is deleted and created again, as attrs.modify would cast
+    value to the existing type, truncating strings and rounding numbers.
+    """
+    if name in attrs:
+        existing = attrs.get_id(name)
+        array = numpy.asarray(value)
+        if array.dtype.kind == 'U':
+            same_type = h5py.check_dtype(vlen=existing.dtype) is str
+        else:
+            same_type = array.dtype.kind in 'biufc' and existing.dtype == array.dtype
+        if same_type and existing.shape == array.shape:
+            if numpy.array_equal(attrs[name], value):
+                return
+            attrs.modify(name, value)
+            return
+        del attrs[name]
+    attrs[name] = value
+
+
+def _dataset_value(dataset):
+    """
+    returns the whole contents of dataset, as Dataset.value did before it was
+    removed in h5py 3, decoding strings which h5py 3 reads as bytes
+    """
+    value = dataset[()]
+    if isinstance(value, bytes) and h5py.check_dtype(vlen=dataset.dtype) is str:
+        value = value.decode('utf-8')
+    return value
+
+
+def _content_hash(data):
+    """returns a sha1 hash of data, which may be a string or array_like"""
+    import hashlib
+
+    if isinstance(data, str):
+        content = b'str:' + data.encode('utf-8')
+    elif isinstance(data, bytes):
+        content = b'bytes:' + data
+    else:
+        data = numpy.asarray(data)
+        if data.dtype.kind == 'O':
+            content = b'object:' + repr(data.tolist()).encode('utf-8')
+        else:
+            content = ('%s%s:'%(data.dtype.str, data.shape)).encode('utf-8') + data.tobytes()
+    return hashlib.sha1(content).hexdigest()
+
+
 class HLObject(object):
     """
     This adds functionality to every class below, as they are all ansesters
@@ -36,13 +91,18 @@ class HLObject(object):
     __h5scripting__ types
     """
 
+    # The path of the file this object was opened from, passed down from
+    # File to the objects opened through it.  HDF5 gives a file opened from
+    # an in-memory image a new name every time it is opened.
+    _h5scripting_filename = None
+
     @property
     def docstring(self):
         return self.attrs['__h5scripting__doc__']
 
     @docstring.setter
     def docstring(self, value):
-        self.attrs['__h5scripting__doc__'] = value
+        _write_attribute(self.attrs, '__h5scripting__doc__', value)
 
     @property
     def h5scripting_id(self):
@@ -50,7 +110,7 @@ class HLObject(object):
 
     @h5scripting_id.setter
     def h5scripting_id(self, value):
-        self.attrs['__h5scripting__'] = value
+        _write_attribute(self.attrs, '__h5scripting__', value)
 
     def _check_h5scripting_id(self, type_string):
         valid = ('__h5scripting__doc__' in self.attrs and
@@ -89,6 +149,34 @@ class Dataset(HLObject, h5py.Dataset):
         self._ErrorCheck = ErrorCheck
         self._valid_h5scripting_object(h5scripting_id, throw_error = True)
 
+    def __getitem__(self, args, *more_args, **kwargs):
+        """ Read a slice from the dataset, through the slice cache if enabled """
+        if _slice_cache is None or more_args or kwargs:
+            return super().__getitem__(args, *more_args, **kwargs)
+        return _slice_cache.read(self, args)
+
+    def __setitem__(self, args, val):
+        super().__setitem__(args, val)
+        if _slice_cache is not None:
+            _slice_cache.invalidate(self)
+        _drop_pyramid(self)
+
+    def write_direct(self, *args, **kwargs):
+        super().write_direct(*args, **kwargs)
+        if _slice_cache is not None:
+            _slice_cache.invalidate(self)
+        _drop_pyramid(self)
+
+    def resize(self, *args, **kwargs):
+        super().resize(*args, **kwargs)
+        if _slice_cache is not None:
+            _slice_cache.invalidate(self)
+        _drop_pyramid(self)
+
+    def preview(self, resolution, selection=None):
+        """ Read a decimated preview of the dataset, see read_preview """
+        return read_preview(self, resolution, selection)
+
 class GroupMixins():
     def create_group(self, name, 
                  docstring = "", h5scripting_id = "group"):
@@ -103,6 +191,7 @@ class GroupMixins():
         name, lcpl = self._e(name, lcpl=True)
         gid = h5py.h5g.create(self.id, name, lcpl=lcpl)
         grp = Group(gid, ErrorCheck=False)
+        grp._h5scripting_filename = self._h5scripting_filename
 
         # if possible tag the group
         grp.h5scripting_id = h5scripting_id
@@ -113,7 +202,7 @@ class GroupMixins():
         return grp
 
     def create_dataset(self, name, shape=None, dtype=None, data=None, 
-                       docstring = "", h5scripting_id = "dataset", **kwds):
+                       docstring = "", h5scripting_id = "dataset", pyramid = False, **kwds):
         """ Create a new h5scripting managed HDF5 dataset
 
         name
@@ -162,11 +251,31 @@ class GroupMixins():
         track_times
             (T/F) Enable dataset creation timestamps.
 
-        Accepts docstring = "", h5scripting_id = "group"
+        Accepts docstring = "", h5scripting_id = "group", and pyramid = False,
+        which when True builds preview levels of a 1-D or 2-D numeric dataset
+        with build_pyramid().  Other datasets then raise a TypeError before
+        anything is created.
         """
+
+        # Check for a pyramid up front, rather than leave a dataset behind
+        if pyramid:
+            if name is None:
+                raise ValueError('Pyramids can only be built for named datasets')
+            pyramid_shape, pyramid_dtype = shape, dtype
+            if data is not None:
+                array = numpy.asarray(data)
+                if pyramid_shape is None:
+                    pyramid_shape = array.shape
+                if pyramid_dtype is None:
+                    pyramid_dtype = array.dtype
+            if isinstance(pyramid_shape, int):
+                pyramid_shape = (pyramid_shape,)
+            if pyramid_shape is not None:
+                _check_pyramid(pyramid_shape, 'f' if pyramid_dtype is None else pyramid_dtype)
          
         dsid = h5py._hl.dataset.make_new_dset(self, shape, dtype, data, **kwds)
         dset = Dataset(dsid, ErrorCheck=False)
+        dset._h5scripting_filename = self._h5scripting_filename
         if name is not None:
             self[name] = dset
 
@@ -175,6 +284,9 @@ class GroupMixins():
             
         if "__h5scripting__doc__" not in dset.attrs or docstring != '':
             dset.docstring = docstring
+
+        if pyramid:
+            build_pyramid(dset)
         
         return dset
 
@@ -230,13 +342,59 @@ class GroupMixins():
                                      docstring=docstring, 
                                      h5scripting_id=h5scripting_id)
         grp = self.getitem(name, h5scripting_id=h5scripting_id)
-        grp.docstring = docstring
+        # Only rewrite the docstring when given a new one
+        if docstring != '':
+            grp.docstring = docstring
         grp.h5scripting_id = h5scripting_id
         
         if not isinstance(grp, Group):
             raise TypeError("Incompatible object (%s) already exists" % grp.__class__.__name__)
         return grp
 
+    def write_dataset(self, name, data, docstring = "", h5scripting_id = "dataset", **kwds):
+        """ Create an h5scripting managed dataset, or overwrite an existing one.
+
+        When the existing dataset has the same shape and dtype as data, its
+        contents are read and compared with data, and data is written in
+        place only if they differ.  Only otherwise is the dataset deleted
+        and created again, leaving behind space that HDF5 does not reclaim
+        (see repack).
+
+        Other dataset keywords (see create_dataset) may be provided, but are
+        only used if a new dataset is to be created.
+
+        Accepts docstring = "", h5scripting_id = "dataset"
+        """
+        if name in self:
+            dset = self.getitem(name, h5scripting_id=h5scripting_id)
+            if not isinstance(dset, Dataset):
+                raise TypeError("Incompatible object (%s) already exists" % dset.__class__.__name__)
+
+            if isinstance(data, str):
+                string_type = h5py.check_dtype(vlen=dset.dtype)
+                compatible = dset.shape == () and string_type is not None and string_type is not bytes
+            else:
+                array = numpy.asarray(data)
+                compatible = dset.shape == array.shape and dset.dtype == array.dtype
+            if compatible:
+                # Compare with the file itself, around the slice cache, as the
+                # dataset may have been written by other means
+                existing = h5py.Dataset.__getitem__(dset, ())
+                if isinstance(data, str):
+                    unchanged = existing in (data, data.encode('utf-8'))
+                else:
+                    unchanged = numpy.array_equal(existing, array)
+                if not unchanged:
+                    dset[()] = data
+                dset.docstring = docstring
+                return dset
+
+            _drop_pyramid(dset)
+            del self[name]
+
+        return self.create_dataset(name, data=data, docstring=docstring,
+                                   h5scripting_id=h5scripting_id, **kwds)
+
     def getitem(self, name, h5scripting_id = None):
         """ Open an object in the file """
         if isinstance(name, h5py.h5r.Reference):
@@ -249,22 +407,24 @@ class GroupMixins():
         otype = h5py.h5i.get_type(oid)
         if h5scripting_id is None:
             if otype == h5py.h5i.GROUP:
-                return Group(oid, ErrorCheck = self._ErrorCheck)
+                obj = Group(oid, ErrorCheck = self._ErrorCheck)
             elif otype == h5py.h5i.DATASET:
-                return Dataset(oid, ErrorCheck = self._ErrorCheck)
+                obj = Dataset(oid, ErrorCheck = self._ErrorCheck)
             elif otype == h5py.h5i.DATATYPE:
                 return h5py.datatype.Datatype(oid)
             else:
                 raise TypeError("Unknown object type")
         else: # New case to allow different h5scripting_id tags
             if otype == h5py.h5i.GROUP:
-                return Group(oid, ErrorCheck = self._ErrorCheck, h5scripting_id = h5scripting_id)
+                obj = Group(oid, ErrorCheck = self._ErrorCheck, h5scripting_id = h5scripting_id)
             elif otype == h5py.h5i.DATASET:
-                return Dataset(oid, ErrorCheck = self._ErrorCheck, h5scripting_id = h5scripting_id)
+                obj = Dataset(oid, ErrorCheck = self._ErrorCheck, h5scripting_id = h5scripting_id)
             elif otype == h5py.h5i.DATATYPE:
                 return h5py.datatype.Datatype(oid)
             else:
                 raise TypeError("Unknown object type")
+        obj._h5scripting_filename = self._h5scripting_filename
+        return obj
             
         
 
@@ -289,6 +449,12 @@ class File(GroupMixins, HLObject, h5py.File):
     def __init__(self, name, mode=None, 
                  docstring = "", h5scripting_id = "file", ErrorCheck = True, 
                  *args, **kwargs):
+        if isinstance(name, str):
+            self._h5scripting_filename = os.path.abspath(name)
+
+        # Small files may be served from, or loaded whole into, memory
+        if _file_images is not None:
+            name, kwargs = _file_images.route(name, mode, kwargs)
         super().__init__(name, mode=mode, *args, **kwargs)
 
         self._ErrorCheck = ErrorCheck
@@ -331,6 +497,635 @@ class File(GroupMixins, HLObject, h5py.File):
 #
 # -----------------------------------------------------------------------------
 
+# -----------------------------------------------------------------------------
+#
+# START Low level traversal
+#
+# -----------------------------------------------------------------------------
+
+TaggedObject = collections.namedtuple('TaggedObject',
+    ['name', 'path', 'type', 'h5scripting_id', 'docstring', 'shape', 'dtype'])
+TaggedObject.__doc__ = """
+A compact record of an h5scripting managed object found by iter_tagged_objects
+
+name : path relative to the group the traversal started from
+path : absolute path in the file
+type : 'group' or 'dataset'
+h5scripting_id : value of the __h5scripting__ attribute
+docstring : value of the __h5scripting__doc__ attribute
+shape, dtype : of datasets, None for groups
+"""
+
+def _read_attribute(loc, obj_name, attr_name):
+    """
+    returns the value of the attribute attr_name of the object at obj_name
+    relative to the low level object loc, or None if it has no such attribute
+    """
+    attr_name = attr_name.encode('utf-8')
+    if not h5py.h5a.exists(loc, attr_name, obj_name=obj_name):
+        return None
+    attr = h5py.h5a.open(loc, attr_name, obj_name=obj_name)
+    value = numpy.ndarray(attr.shape, dtype=attr.dtype)
+    attr.read(value, mtype=h5py.h5t.py_create(attr.dtype))
+    value = value[()]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value
+
+
+def iter_tagged_objects(group, h5scripting_id=None, recursive=True):
+    """
+    Yields a TaggedObject for every h5scripting managed group and dataset
+    below group, in the order of h5py's visititems.
+
+    This works on h5py's low level h5o/h5a interface: each object is visited
+    once and its __h5scripting__ attributes are read by name, without
+    building a high level wrapper for it.  Datasets are only opened, to
+    get their shape and dtype, when they match h5scripting_id.
+
+    group : h5py group or file to start from
+
+    h5scripting_id : if not None, only objects with this __h5scripting__
+        attribute are yielded.  May also be a tuple of accepted values.
+
+    recursive : if False, only the immediate members of group are visited
+    """
+    if isinstance(h5scripting_id, str):
+        h5scripting_id = (h5scripting_id,)
+
+    loc = group.id
+    types = {h5py.h5o.TYPE_GROUP: 'group', h5py.h5o.TYPE_DATASET: 'dataset'}
+
+    members = []
+    if recursive:
+        def visitor(name, info):
+            if name != b'.' and info.type in types:
+                members.append((name, types[info.type]))
+        h5py.h5o.visit(loc, visitor, info=True)
+    else:
+        for name in loc:
+            try:
+                info = h5py.h5o.get_info(loc, name)
+            except (KeyError, RuntimeError):
+                # A dangling soft or external link
+                continue
+            if info.type in types:
+                members.append((name, types[info.type]))
+
+    base = group.name.rstrip('/')
+    for name, object_type in members:
+        tag = _read_attribute(loc, name, '__h5scripting__')
+        if tag is None or (h5scripting_id is not None and tag not in h5scripting_id):
+            continue
+        docstring = _read_attribute(loc, name, '__h5scripting__doc__')
+        if docstring is None:
+            continue
+
+        shape = dtype = None
+        if object_type == 'dataset':
+            dsid = h5py.h5d.open(loc, name)
+            shape = dsid.shape
+            dtype = dsid.dtype
+
+        name = name.decode('utf-8')
+        yield TaggedObject(name, base + '/' + name, object_type, tag, docstring, shape, dtype)
+
+# -----------------------------------------------------------------------------
+#
+# END Low level traversal
+#
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#
+# START In-memory file images
+#
+# -----------------------------------------------------------------------------
+
+class FileImageCache(object):
+    """
+    Keeps whole h5 files in memory, so that repeatedly opening a small file
+    (for example with several calls to get_saved_function or get_all_data)
+    reads it from disk only once.  Enable with enable_file_images().
+
+    Files opened read only are opened from an in-memory HDF5 file image,
+    which is read from disk on first use and again only when the file's
+    modification time or size changes.  Files opened for writing use the
+    HDF5 core driver, which reads the file into memory when it is opened
+    and writes it back in one go when it is closed.
+    
+    max_file_size : files larger than this many bytes use normal I/O
+
+    max_total_size : the least recently used images are dropped to keep
+        the total size of the cached images below this many bytes
+    """
+
+    def __init__(self, max_file_size=2**26, max_total_size=2**30):
+        import threading
+
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename):
+        """
+        returns the image of filename as bytes, reading it from disk if it
+        is not cached or out of date, or None if it is too large to cache
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size > self.max_file_size:
+            return None
+
+        with self._lock:
+            if path in self._images and self._images[path][0] == stamp:
+                self._images.move_to_end(path)
+                self.hits += 1
+                return self._images[path][1]
+            self._discard(path)
+
+        with open(path, 'rb') as f:
+            image = f.read()
+
+        with self._lock:
+            self.misses += 1
+            self._discard(path)
+            self._images[path] = (stamp, image)
+            self.total_size += len(image)
+            while self.total_size > self.max_total_size and len(self._images) > 1:
+                self._discard(next(iter(self._images)))
+                self.evictions += 1
+        return image
+
+    def _discard(self, path):
+        if path in self._images:
+            self.total_size -= len(self._images.pop(path)[1])
+
+    def invalidate(self, filename):
+        """drops the image of filename, if cached"""
+        with self._lock:
+            self._discard(os.path.abspath(filename))
+
+    def clear(self):
+        """drops all cached images"""
+        with self._lock:
+            self._images.clear()
+            self.total_size = 0
+
+    def route(self, name, mode, kwargs):
+        """
+        returns the (name, kwargs) to open the file name in mode with,
+        given the keyword arguments kwargs passed to File
+        """
+        if (not isinstance(name, str) or 'driver' in kwargs or
+            mode in ('w', 'w-', 'x') or not os.path.isfile(name)):
+            return name, kwargs
+
+        if mode == 'r':
+            image = self.get(name)
+            if image is not None:
+                return h5py.h5f.open_file_image(image), kwargs
+        elif os.path.getsize(name) <= self.max_file_size:
+            self.invalidate(name)
+            kwargs = dict(kwargs, driver='core', backing_store=True)
+        return name, kwargs
+
+    def stats(self):
+        """returns a dictionary of cache statistics"""
+        with self._lock:
+            return {'files': len(self._images),
+                    'total_size': self.total_size,
+                    'max_file_size': self.max_file_size,
+                    'max_total_size': self.max_total_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+_file_images = None
+
+def enable_file_images(max_file_size=2**26, max_total_size=2**30):
+    """
+    Routes every File opened by h5scripting through a new FileImageCache,
+    which is returned.  See FileImageCache for the arguments.
+    """
+    global _file_images
+    _file_images = FileImageCache(max_file_size, max_total_size)
+    return _file_images
+
+def disable_file_images():
+    """Returns to normal I/O for all files, dropping any cached images"""
+    global _file_images
+    if _file_images is not None:
+        _file_images.clear()
+    _file_images = None
+
+# -----------------------------------------------------------------------------
+#
+# END In-memory file images
+#
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#
+# START Slice cache
+#
+# -----------------------------------------------------------------------------
+
+def _selection_key(args):
+    """
+    returns a hashable key for the selection args passed to
+    Dataset.__getitem__, or None if the selection cannot be cached
+    """
+    if not isinstance(args, tuple):
+        args = (args,)
+
+    key = []
+    for arg in args:
+        if isinstance(arg, slice):
+            key.append(('slice', arg.start, arg.stop, arg.step))
+        elif arg is Ellipsis:
+            key.append('...')
+        elif arg is None:
+            key.append('newaxis')
+        elif isinstance(arg, (int, numpy.integer)):
+            key.append(int(arg))
+        elif isinstance(arg, str):
+            key.append(('field', arg))
+        elif isinstance(arg, (list, numpy.ndarray)):
+            arg = numpy.asarray(arg)
+            if arg.dtype.kind not in 'biu':
+                return None
+            key.append((arg.dtype.str, arg.shape, arg.tobytes()))
+        else:
+            return None
+    return tuple(key)
+
+
+class SliceCache(object):
+    """
+    A least recently used cache of the results of reading slices from
+    h5scripting Datasets.  Enable with enable_slice_cache().
+
+    Entries are keyed by the file, the dataset path and the selection.  They
+    are dropped when the dataset is written through h5scripting, and are not
+    used once the file's modification time or size changes.  Results are
+    copied on the way out, so they can be modified freely.
+
+    max_size : the least recently used entries are dropped to keep the total
+        size of the cached results below this many bytes
+    """
+
+    def __init__(self, max_size=2**28):
+        import threading
+
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._datasets = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+
+    @staticmethod
+    def _dataset_key(dataset):
+        filename = dataset._h5scripting_filename
+        if filename is None:
+            filename = h5py.h5f.get_name(dataset.id).decode('utf-8', 'replace')
+        return (filename, dataset.name)
+
+    @staticmethod
+    def _file_stamp(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # For example an in-memory file image
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read(self, dataset, args):
+        """returns dataset[args], from the cache if possible"""
+        selection = _selection_key(args)
+        if selection is None:
+            self.uncached += 1
+            return h5py.Dataset.__getitem__(dataset, args)
+
+        dataset_key = self._dataset_key(dataset)
+        key = dataset_key + (self._file_stamp(dataset_key[0]), selection)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                result = self._entries[key][0]
+                return result.copy() if isinstance(result, numpy.ndarray) else result
+
+        result = h5py.Dataset.__getitem__(dataset, args)
+        size = result.nbytes if isinstance(result, numpy.ndarray) else sys.getsizeof(result)
+
+        with self._lock:
+            self.misses += 1
+            if size <= self.max_size:
+                self._discard(key)
+                self._entries[key] = (result, size)
+                self._datasets[dataset_key].add(key)
+                self.total_size += size
+                while self.total_size > self.max_size:
+                    self._discard(next(iter(self._entries)))
+                    self.evictions += 1
+        return result.copy() if isinstance(result, numpy.ndarray) else result
+
+    def _discard(self, key):
+        if key in self._entries:
+            self.total_size -= self._entries.pop(key)[1]
+            self._datasets[key[:2]].discard(key)
+            if not self._datasets[key[:2]]:
+                del self._datasets[key[:2]]
+
+    def invalidate(self, dataset):
+        """drops all cached slices of dataset"""
+        dataset_key = self._dataset_key(dataset)
+        with self._lock:
+            for key in list(self._datasets.get(dataset_key, ())):
+                self._discard(key)
+
+    def clear(self):
+        """drops all cached slices"""
+        with self._lock:
+            self._entries.clear()
+            self._datasets.clear()
+            self.total_size = 0
+
+    def stats(self):
+        """returns a dictionary of cache statistics"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'total_size': self.total_size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'uncached': self.uncached}
+
+
+_slice_cache = None
+
+def enable_slice_cache(max_size=2**28):
+    """
+    Caches the slices read through every h5scripting Dataset in a new
+    SliceCache, which is returned.  See SliceCache for the arguments.
+    """
+    global _slice_cache
+    _slice_cache = SliceCache(max_size)
+    return _slice_cache
+
+def disable_slice_cache():
+    """Reads all slices from the file again, dropping any cached slices"""
+    global _slice_cache
+    if _slice_cache is not None:
+        _slice_cache.clear()
+    _slice_cache = None
+
+# -----------------------------------------------------------------------------
+#
+# END Slice cache
+#
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+#
+# START Preview pyramids
+#
+# -----------------------------------------------------------------------------
+
+Preview = collections.namedtuple('Preview', ['min', 'max', 'mean', 'step'])
+Preview.__doc__ = """
+A decimated view of a slice of a dataset returned by read_preview
+
+min, max, mean : arrays of the minimum, maximum and mean of each block
+step : number of samples of the dataset in each block, along each axis
+"""
+
+def _pyramid_name(dataset):
+    return dataset.name.split('/')[-1] + '_pyramid'
+
+
+def _pyramid_stamp(dataset):
+    """
+    returns a string that changes when dataset is replaced by another, or
+    is resized
+    """
+    info = h5py.h5o.get_info(dataset.id)
+    return repr((info.addr, dataset.shape, dataset.dtype.str))
+
+
+def _drop_pyramid(dataset):
+    """deletes the pyramid of dataset, if it has one"""
+    if dataset.name is None:
+        return
+    parent = dataset.parent
+    name = _pyramid_name(dataset)
+    if name in parent and parent[name].attrs.get('__h5scripting__') == 'pyramid':
+        del parent[name]
+
+
+def _check_pyramid(shape, dtype):
+    """raises a TypeError if a dataset of shape and dtype cannot have a pyramid"""
+    if len(shape) not in (1, 2) or numpy.dtype(dtype).kind not in 'biuf':
+        raise TypeError('Pyramids can only be built for 1-D or 2-D numeric datasets')
+
+
+def _block_counts(length, step, start, stop):
+    """
+    returns the number of samples of an axis of the given length in each of
+    the blocks start to stop, where each block holds step samples
+    """
+    first = numpy.arange(start, stop) * step
+    return numpy.minimum(first + step, length) - first
+
+
+def _decimate(mins, maxs, means, counts, factor):
+    """
+    reduces every factor blocks along each axis to one, where counts is the
+    number of samples in each block
+    """
+    for axis in range(mins.ndim):
+        indices = numpy.arange(0, mins.shape[axis], factor)
+        mins = numpy.minimum.reduceat(mins, indices, axis=axis)
+        maxs = numpy.maximum.reduceat(maxs, indices, axis=axis)
+        sums = numpy.add.reduceat(means * counts, indices, axis=axis)
+        counts = numpy.add.reduceat(counts, indices, axis=axis)
+        means = sums / counts
+    return mins, maxs, means
+
+
+def build_pyramid(dataset, factor=4, min_length=1024, block_size=2**24):
+    """
+    Builds a pyramid of decimated previews of a 1-D or 2-D numeric dataset,
+    for plotting functions to read with read_preview.
+
+    The pyramid is a group named after the dataset with a '_pyramid'
+    suffix, tagged 'pyramid', next to the dataset.  Level n holds datasets
+    min_n, max_n and mean_n of blocks of factor**n samples along each axis.
+    Levels are added until every axis is at most min_length long.  Any
+    existing pyramid of the dataset is replaced.
+
+    The pyramid is deleted when the dataset is written through h5scripting,
+    and ignored by read_preview once the dataset has been replaced or
+    resized by other means.  Writing to the dataset in place by other means
+    leaves it out of date.
+
+    dataset : the dataset, in a file open for writing
+
+    factor : the decimation factor between levels
+
+    min_length : length along every axis of the coarsest level
+
+    block_size : approximate number of bytes of the dataset or of a level
+        to hold in memory at once
+
+    returns the pyramid group, or None if the dataset is small enough not
+    to need one
+    """
+    _check_pyramid(dataset.shape, dataset.dtype)
+
+    parent = Group(dataset.parent.id, ErrorCheck=False)
+    name = _pyramid_name(dataset)
+    if name in parent:
+        del parent[name]
+
+    shape = dataset.shape
+    levels = []
+    step = 1
+    while max(-(-length // step) for length in shape) > min_length:
+        step *= factor
+        levels.append(tuple(-(-length // step) for length in shape))
+    if not levels:
+        return None
+
+    grp = parent.create_group(name, docstring='decimated previews of %s'%dataset.name,
+                              h5scripting_id='pyramid')
+    grp.attrs['__h5scripting__pyramid_factor__'] = factor
+    grp.attrs['__h5scripting__pyramid_levels__'] = len(levels)
+    grp.attrs['__h5scripting__pyramid_source__'] = _pyramid_stamp(dataset)
+
+    for level, level_shape in enumerate(levels, 1):
+        step = factor**(level - 1)
+        if level == 1:
+            sources = (dataset, dataset, dataset)
+        else:
+            sources = [grp['%s_%d'%(kind, level - 1)] for kind in ('min', 'max', 'mean')]
+        targets = [grp.create_dataset('%s_%d'%(kind, level), shape=level_shape, dtype=dtype,
+                                      docstring='%s of blocks of %d samples of %s'%(kind, factor*step, dataset.name),
+                                      h5scripting_id='pyramid_level')
+                   for kind, dtype in (('min', dataset.dtype), ('max', dataset.dtype), ('mean', 'f8'))]
+
+        source_shape = sources[0].shape
+        row_size = 8 * (source_shape[1] if len(source_shape) == 2 else 1)
+        rows = max(block_size // row_size // factor, 1) * factor
+        for start in range(0, source_shape[0], rows):
+            stop = min(start + rows, source_shape[0])
+            # Read around the slice cache, these blocks are only needed once
+            mins, maxs, means = [h5py.Dataset.__getitem__(source, slice(start, stop)) for source in sources]
+            counts = _block_counts(shape[0], step, start, stop)
+            if len(shape) == 2:
+                counts = numpy.outer(counts, _block_counts(shape[1], step, 0, source_shape[1]))
+            mins, maxs, means = _decimate(mins, maxs, means.astype('f8'), counts, factor)
+            for target, block in zip(targets, (mins, maxs, means)):
+                # Write around Dataset.__setitem__, which would look for a
+                # pyramid of each level
+                h5py.Dataset.__setitem__(target, slice(start // factor, start // factor + block.shape[0]), block)
+
+    return grp
+
+
+def add_pyramids(filename, groupname=None, min_size=2**20, factor=4, min_length=1024):
+    """
+    Builds pyramids (see build_pyramid) for the 1-D and 2-D numeric datasets
+    of an existing h5 file that have at least min_size elements.
+
+    filename : h5 file to use
+
+    groupname : only datasets below this group are considered.  Defaults to
+        None, in which case the whole file is.
+
+    returns the paths of the datasets pyramids were built for
+    """
+    paths = []
+    with File(filename, 'r+') as f:
+        f._ErrorCheck = False
+        grp = f if groupname is None else f[groupname]
+        for record in list(iter_tagged_objects(grp, 'dataset')):
+            if (record.shape is not None and len(record.shape) in (1, 2) and
+                record.dtype.kind in 'biuf' and numpy.prod(record.shape) >= min_size):
+                if build_pyramid(f[record.path], factor, min_length) is not None:
+                    paths += [record.path,]
+    return paths
+
+
+def read_preview(dataset, resolution, selection=None):
+    """
+    Reads a slice of a dataset at no more than the resolution needed, from
+    the coarsest level of its pyramid (see build_pyramid) that still has
+    at least resolution samples across the slice.
+
+    dataset : the dataset, an h5scripting or h5py Dataset
+
+    resolution : number of samples wanted across the slice, or a tuple
+        giving this for each axis
+
+    selection : a slice, or a tuple of a slice for each axis, with step 1.
+        Defaults to None, in which case the whole dataset is used.
+
+    returns a Preview.  If the dataset has no pyramid, no level of it is
+        coarse enough, or it was built for a dataset since replaced or
+        resized, min, max and mean are all the slice itself and step is 1.
+    """
+    if selection is None:
+        selection = ()
+    elif not isinstance(selection, tuple):
+        selection = (selection,)
+    selection = selection + (slice(None),) * (dataset.ndim - len(selection))
+    if isinstance(resolution, (int, numpy.integer)):
+        resolution = (resolution,) * dataset.ndim
+
+    bounds = []
+    for axis_selection, length in zip(selection, dataset.shape):
+        start, stop, step = axis_selection.indices(length)
+        if step != 1:
+            raise ValueError('Previews can only be read of slices with step 1')
+        bounds.append((start, max(stop, start)))
+
+    name = _pyramid_name(dataset)
+    parent = dataset.parent
+    if (name in parent and parent[name].attrs.get('__h5scripting__') == 'pyramid' and
+        parent[name].attrs.get('__h5scripting__pyramid_source__') == _pyramid_stamp(dataset)):
+        pyramid = parent[name]
+        factor = int(pyramid.attrs['__h5scripting__pyramid_factor__'])
+        for level in range(int(pyramid.attrs['__h5scripting__pyramid_levels__']), 0, -1):
+            step = factor**level
+            level_selection = tuple(slice(start // step, -(-stop // step)) for start, stop in bounds)
+            if all(axis_selection.stop - axis_selection.start >= axis_resolution
+                   for axis_selection, axis_resolution in zip(level_selection, resolution)):
+                return Preview(*[pyramid['%s_%d'%(kind, level)][level_selection]
+                                 for kind in ('min', 'max', 'mean')], step=step)
+
+    data = dataset[tuple(slice(start, stop) for start, stop in bounds)]
+    return Preview(data, data, data, 1)
+
+# -----------------------------------------------------------------------------
+#
+# END Preview pyramids
+#
+# -----------------------------------------------------------------------------
+
 def exec_in_namespace(code, namespace):
     if sys.version < '3':
         exec("""exec code in namespace""")
@@ -341,7 +1136,322 @@ def exec_in_namespace(code, namespace):
             exec_func = getattr(__builtins__, 'exec')
         exec_func(code, namespace) 
 
+
+def find_dataset_paths(function_source):
+    """
+    Statically analyses the source of a function and returns a sorted list
+    of the literal paths it uses to index h5 objects.
     
+    Both f['/data/x'] and chained lookups such as f['data']['x'] are found,
+    the latter being returned as 'data/x'.  Any other literal string
+    subscript (for example of an ordinary dictionary) will also be returned,
+    so the result should be treated as a list of candidates only.
+    """
+
+    def literal_string(node):
+        slc = node.slice
+        # Python < 3.9 wraps subscripts in an ast.Index node
+        if type(slc).__name__ == 'Index':
+            slc = slc.value
+        if isinstance(slc, ast.Constant) and isinstance(slc.value, str):
+            return slc.value
+        return None
+
+    paths = set()
+    inner = set()
+    for node in ast.walk(ast.parse(function_source)):
+        # ast.walk is breadth first, so the outermost subscript of a
+        # chain is seen before those it contains
+        if not isinstance(node, ast.Subscript) or id(node) in inner:
+            continue
+        parts = []
+        while isinstance(node, ast.Subscript):
+            part = literal_string(node)
+            if part is None:
+                break
+            parts.insert(0, part)
+            inner.add(id(node.value))
+            node = node.value
+        if parts:
+            paths.add('/'.join(part.rstrip('/') for part in parts))
+
+    return sorted(paths)
+
+
+def _dataset_byte_ranges(dsid):
+    """
+    returns the [(offset, size), ] byte ranges in the file holding the
+    data of the low level dataset dsid
+    """
+    offset = dsid.get_offset()
+    if offset is not None:
+        return [(offset, dsid.get_storage_size())]
+
+    ranges = []
+    try:
+        for index in range(dsid.get_num_chunks()):
+            info = dsid.get_chunk_info(index)
+            ranges.append((info.byte_offset, info.size))
+    except (AttributeError, RuntimeError):
+        # Chunk queries need h5py >= 2.10 and HDF5 >= 1.10.5
+        pass
+    return ranges
+
+
+def _read_byte_range(filename, offset, size, block_size):
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            block = f.read(min(size, block_size))
+            if not block:
+                break
+            size -= len(block)
+
+
+def prefetch_datasets(filename, paths, max_workers=None, block_size=2**20):
+    """
+    Reads the raw storage of the datasets at paths concurrently, so that the
+    operating system's page cache is warm by the time they are read through
+    HDF5.  For cold reads from a network filesystem this overlaps the I/O
+    latency of every dataset, rather than paying it serially.
+
+    filename : h5 file to use
+
+    paths : list of dataset paths.  Paths that do not exist or that are not
+        datasets are ignored.
+
+    max_workers : number of reader threads, defaults to that of
+        concurrent.futures.ThreadPoolExecutor
+
+    block_size : size of each read in bytes
+
+    returns the number of bytes prefetched
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    ranges = []
+    with h5py.File(filename, 'r') as f:
+        for path in paths:
+            try:
+                obj = f.get(path)
+            except (KeyError, ValueError):
+                continue
+            if isinstance(obj, h5py.Dataset):
+                ranges += _dataset_byte_ranges(obj.id)
+
+    # Coalesce neighbouring ranges so that each results in a single read
+    coalesced = []
+    for offset, size in sorted(ranges):
+        if coalesced and offset <= coalesced[-1][0] + coalesced[-1][1]:
+            last_offset, last_size = coalesced[-1]
+            coalesced[-1] = (last_offset, max(last_size, offset + size - last_offset))
+        else:
+            coalesced.append((offset, size))
+
+    if coalesced:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for offset, size in coalesced:
+                executor.submit(_read_byte_range, filename, offset, size, block_size)
+
+    return sum(size for offset, size in coalesced)
+
+
+def _source_hash(function_source):
+    import hashlib
+    return hashlib.sha1(function_source.encode('utf-8')).hexdigest()
+
+
+def _dataset_checksum(dataset, block_size=2**24):
+    """
+    returns an adler32 checksum of the contents of dataset, read in blocks
+    of about block_size bytes
+    """
+    import zlib
+
+    if not dataset.shape:
+        blocks = [dataset[()]]
+    else:
+        row_size = dataset.dtype.itemsize * (dataset.size // max(dataset.shape[0], 1))
+        rows = max(block_size // max(row_size, 1), 1)
+        blocks = (dataset[i:i + rows] for i in range(0, dataset.shape[0], rows))
+
+    checksum = 1
+    for block in blocks:
+        block = numpy.asarray(block)
+        if block.dtype.kind == 'O':
+            block = repr(block.tolist()).encode()
+        else:
+            block = numpy.ascontiguousarray(block).tobytes()
+        checksum = zlib.adler32(block, checksum)
+    return checksum
+
+
+def _dataset_stamp(dataset):
+    """
+    returns a tuple of literals that changes whenever dataset is rewritten.
+    
+    This is based on the modification time HDF5 records for the dataset,
+    or on a checksum of its contents when that time is unknown.  h5py 3
+    creates datasets without modification times and does not report them
+    through h5o.get_info, so there the whole dataset is read to checksum it.
+    """
+    info = h5py.h5o.get_info(dataset.id)
+    stamp = (info.addr, dataset.shape, dataset.dtype.str)
+    if info.mtime:
+        return stamp + (info.mtime,)
+    return stamp + (_dataset_checksum(dataset),)
+
+
+def _argument_stamp(value):
+    """
+    returns a string identifying the argument value, in which arrays are
+    represented by a hash of their contents, as their repr elides all but
+    a few elements of large arrays
+    """
+    if isinstance(value, numpy.ndarray):
+        return 'array(%s)'%_content_hash(value)
+    if isinstance(value, (list, tuple)):
+        return '%s(%s)'%(type(value).__name__, ', '.join(_argument_stamp(item) for item in value))
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: repr(item[0]))
+        return '{%s}'%', '.join('%r: %s'%(key, _argument_stamp(item)) for key, item in items)
+    return repr(value)
+
+    
+_MIN_DATASET_ARGUMENT_LENGTH = 1000
+
+class DatasetArgument(object):
+    """
+    Stands in for an argument of a saved function that is saved as a dataset,
+    until it is read with load() when the function is called.
+    
+    path : absolute path of the dataset
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, filename):
+        """returns the argument saved in the h5 file filename"""
+        with File(filename, 'r') as f:
+            dataset = f.getitem(self.path, h5scripting_id='function_argument')
+            value = _dataset_value(dataset)
+            argument_type = dataset.attrs['__h5scripting__argument_type__']
+        if argument_type == 'list':
+            value = value.tolist()
+        elif argument_type == 'tuple':
+            value = tuple(value.tolist())
+        return value
+
+    def __repr__(self):
+        return '%s(%r)'%(self.__class__.__name__, self.path)
+
+
+def _dataset_argument(value):
+    """
+    returns the numpy array to save the argument value to a dataset as, or
+    None if it should be saved as a literal.  Only numeric arrays are saved
+    as datasets, others are left to fail the literal check.  Lists and tuples
+    are only saved as datasets when their items are all numbers of the same
+    type, so that tolist() gives them back unchanged.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value if value.dtype.kind in 'biufc' else None
+    if isinstance(value, (list, tuple)) and len(value) >= _MIN_DATASET_ARGUMENT_LENGTH:
+        item_types = set(type(item) for item in value)
+        number_types = (bool, int, float, complex, numpy.bool_, numpy.number)
+        if len(item_types) != 1 or not issubclass(item_types.pop(), number_types):
+            return None
+        try:
+            array = numpy.asarray(value)
+        except ValueError:
+            return None
+        if array.dtype.kind in 'biufc':
+            return array
+    return None
+
+
+def _load_dataset_arguments(value, functions_groupname):
+    """
+    returns value with the literals standing in for arguments saved as
+    datasets replaced with DatasetArguments
+    """
+    if isinstance(value, dict) and list(value) == ['__h5scripting__argument__']:
+        return DatasetArgument(functions_groupname + '/' + value['__h5scripting__argument__'])
+    return value
+
+
+def _thread_bytes_read():
+    """
+    returns the number of bytes the calling thread has read so far, from
+    any file, or None where this is not available (it is on Linux only)
+    """
+    import threading
+
+    paths = ['/proc/thread-self/io']
+    if hasattr(threading, 'get_native_id'):
+        paths.append('/proc/self/task/%d/io'%threading.get_native_id())
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith('rchar:'):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _profile_call(call, max_lines=25):
+    """
+    calls call() under cProfile, and returns a dictionary describing the
+    call: wall and cpu time in seconds, peak memory allocated during the call
+    (as seen by tracemalloc) and bytes read by the calling thread (-1 if
+    unknown) in bytes, and the cProfile statistics of the max_lines most
+    expensive functions by cumulative time.
+
+    The bytes read are those of every file the thread read, not only h5
+    files, and leave out reads by other threads, such as those of threads
+    the call starts.  Peak memory, on the other hand, includes allocations
+    by every thread of the process.
+    """
+    import io
+    import time
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    elif hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start_read = _thread_bytes_read()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(call)
+    finally:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = time.process_time() - start_cpu
+        end_read = _thread_bytes_read()
+        peak_memory = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+        if not tracing:
+            tracemalloc.stop()
+
+    stats = io.StringIO()
+    pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(max_lines)
+
+    return {'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'peak_memory': peak_memory,
+            'thread_bytes_read': -1 if start_read is None or end_read is None else end_read - start_read,
+            'stats': stats.getvalue()}
+
+
 class attached_function(object):
 
     """
@@ -371,19 +1481,47 @@ class attached_function(object):
     kwargs: dictionary of keyword arguments that will be automatically passed
         to the function.
 
+    Arguments and keyword arguments must be Python literals, except that
+    numeric numpy arrays, and lists or tuples of at least 1000 numbers all of the same
+    type, are saved as datasets tagged 'function_argument' next to the
+    function.  These are
+    read from the file each time the function is called.
+
+    prefetch : if True, the function's source is analysed for the literal
+        paths of the datasets it reads (see find_dataset_paths), and these
+        are saved with the function and prefetched before each call (see
+        prefetch_datasets).
+
+    derived_groupname : if not None, the results of calling the function are
+        stored in a subgroup of this group, named after the function, along
+        with their provenance.  Later calls return the stored results without
+        recomputing them for as long as the function source, the arguments
+        and the datasets the function reads (see find_dataset_paths) are
+        unchanged.  With h5py 3 checking this reads those datasets in full.
+        Results must be arrays or dictionaries of arrays.
+
+    depends_on : list or tuple of the names of other saved functions in
+        groupname whose results this function uses.  run_saved_functions()
+        runs these first, and a function saved with a derived_groupname is
+        recomputed whenever the results of those it depends on change.
+
     note: function should be written assuming that it enters life in
         an empty namespace. This decorator modifies the defined function
         to run in an empty namespace, and to be called with the provided
         arguments and keyword arguments.
     """
 
-    def __init__(self, filename, name=None, docstring=None, groupname='saved_functions', args=None, kwargs=None):
+    def __init__(self, filename, name=None, docstring=None, groupname='saved_functions', args=None, kwargs=None,
+                 prefetch=False, derived_groupname=None, depends_on=None):
         self.name = name
         self.filename = filename
         self.groupname = groupname
         self.docstring = docstring
         self.args = args
         self.kwargs = kwargs
+        self.prefetch = prefetch
+        self.derived_groupname = derived_groupname
+        self.depends_on = depends_on
         
     def __call__(self, function):
         import inspect
@@ -416,6 +1554,18 @@ class attached_function(object):
             args = self.args
         if not (isinstance(args, list) or isinstance(args, tuple)):
             raise TypeError('args must be a list or a tuple')
+
+        # Large arrays and lists are saved to datasets, and referred to by
+        # name from the literals
+        dataset_arguments = {}
+        def literal_argument(value, dataset_name):
+            array = _dataset_argument(value)
+            if array is None:
+                return value
+            dataset_arguments[dataset_name] = (array, type(value).__name__ if isinstance(value, (list, tuple)) else 'array')
+            return {'__h5scripting__argument__': dataset_name}
+
+        args = type(args)(literal_argument(arg, '%s__arg_%d'%(name, i)) for i, arg in enumerate(args))
         function_args = repr(args)
         try:
             assert ast.literal_eval(function_args) == args
@@ -428,14 +1578,24 @@ class attached_function(object):
             kwargs = self.kwargs
         if not isinstance(kwargs, dict):
             raise TypeError('kwargs must be a dictionary')
+        kwargs = dict((key, literal_argument(value, '%s__kwarg_%s'%(name, key))) for key, value in kwargs.items())
         function_kwargs = repr(kwargs)
         try:
             assert ast.literal_eval(function_kwargs) == kwargs
         except Exception:
             raise TypeError('Keyword argument list can contain only Python literals')
+
+        if self.depends_on is None:
+            depends_on = []
+        else:
+            depends_on = self.depends_on
+        if not (isinstance(depends_on, list) or isinstance(depends_on, tuple)):
+            raise TypeError('depends_on must be a list or a tuple')
+        if not all(isinstance(dependency, str) for dependency in depends_on):
+            raise TypeError('depends_on can contain only the names of saved functions')
+        depends_on = list(depends_on)
             
-        argspec = inspect.getargspec(function)
-        function_signature = function_name + inspect.formatargspec(*argspec)
+        function_signature = function_name + str(inspect.signature(function))
         try:
             function_source = inspect.getsource(function)
         except Exception:
@@ -450,25 +1610,67 @@ class attached_function(object):
         # Remove initial indentation from the source:
         function_source = '\n'.join(line[indentation:] for line in function_lines)
 
-        with File(self.filename) as f:
+        if self.prefetch or self.derived_groupname is not None:
+            function_dataset_paths = repr(find_dataset_paths(function_source))
+
+        with File(self.filename, 'a') as f:
             group = f.require_group(self.groupname,  h5scripting_id = 'functions_group')
-            try:
-                del group[name]
-            except KeyError:
-                pass
-            dataset = group.create_dataset(name, data=function_source,
-                                           docstring = function_docstring,
-                                           h5scripting_id = 'function')
-            dataset.attrs['__h5scripting__function_name__'] = function_name
-            dataset.attrs['__h5scripting__function_signature__'] = function_signature
-            dataset.attrs['__h5scripting__function_args__'] = function_args
-            dataset.attrs['__h5scripting__function_kwargs__'] = function_kwargs
+            previous_source = None
+            if name in group:
+                try:
+                    previous = group.getitem(name, h5scripting_id='function')
+                    previous_source = _dataset_value(previous)
+                except TypeError:
+                    # Not a saved function, so cannot be overwritten in place
+                    del group[name]
+
+            # Drop the argument datasets the function no longer has, and its
+            # profile if its source changed
+            for record in list(iter_tagged_objects(group, 'function_argument', recursive=False)):
+                argument = group.getitem(record.name, h5scripting_id='function_argument')
+                if (argument.attrs.get('__h5scripting__argument_of__') == name and
+                    record.name not in dataset_arguments):
+                    del group[record.name]
+            if previous_source != function_source:
+                for record in list(iter_tagged_objects(group, 'function_profile', recursive=False)):
+                    profile = group.getitem(record.name, h5scripting_id='function_profile')
+                    if profile.attrs.get('__h5scripting__profile_of__') == name:
+                        del group[record.name]
+
+            for dataset_name, (array, argument_type) in dataset_arguments.items():
+                argument = group.write_dataset(dataset_name, data=array,
+                                               docstring = 'argument of saved function %s'%name,
+                                               h5scripting_id = 'function_argument')
+                _write_attribute(argument.attrs, '__h5scripting__argument_of__', name)
+                _write_attribute(argument.attrs, '__h5scripting__argument_type__', argument_type)
+            dataset = group.write_dataset(name, data=function_source,
+                                          docstring = function_docstring,
+                                          h5scripting_id = 'function')
+
+            attributes = {'__h5scripting__function_name__': function_name,
+                          '__h5scripting__function_signature__': function_signature,
+                          '__h5scripting__function_args__': function_args,
+                          '__h5scripting__function_kwargs__': function_kwargs}
+            if self.prefetch or self.derived_groupname is not None:
+                attributes['__h5scripting__function_dataset_paths__'] = function_dataset_paths
+            if self.prefetch:
+                attributes['__h5scripting__function_prefetch__'] = True
+            if self.derived_groupname is not None:
+                attributes['__h5scripting__function_derived_groupname__'] = self.derived_groupname
+            if depends_on:
+                attributes['__h5scripting__function_depends_on__'] = repr(depends_on)
+            for key in list(dataset.attrs):
+                if key.startswith('__h5scripting__function_') and key not in attributes:
+                    del dataset.attrs[key]
+            for key, value in attributes.items():
+                _write_attribute(dataset.attrs, key, value)
             
-            saved_function = SavedFunction(dataset)
+            saved_function = SavedFunction(dataset, self.filename)
         return saved_function
 
 
-def attach_function(function, filename, name=None, docstring=None, groupname='saved_functions', args=None, kwargs=None):
+def attach_function(function, filename, name=None, docstring=None, groupname='saved_functions', args=None, kwargs=None,
+                    prefetch=False, derived_groupname=None, depends_on=None):
     """
     Saves the source of a function to an h5 file.
 
@@ -484,31 +1686,55 @@ def attach_function(function, filename, name=None, docstring=None, groupname='sa
         by Python, that means no lambdas, class/instance methods, functools.partial
         objects, C extensions etc, only ordinary Python functions.
     """
-    attacher = attached_function(filename, name, docstring, groupname, args, kwargs)
+    attacher = attached_function(filename, name, docstring, groupname, args, kwargs, prefetch, derived_groupname,
+                                 depends_on)
     saved_function = attacher(function)
     return saved_function
  
 
 class SavedFunction(object):
-    def __init__(self, dataset):
+    def __init__(self, dataset, filename=None):
         """provides a callable from the function saved in the provided dataset.
         
-        filename: The name of the (currently open) h5 file the 
+        filename: The name of the h5 file the dataset is in.  Defaults to
+        the name HDF5 has for the file, which is not a path for files opened
+        from an in-memory image.
         
         This callable executes in an empty namespace, and so does not have
         access to global and local variables in the calling scope.
 
         When called, it automatically receives 'filename' as its first
-        argument, args and kwargs as its arguments and keyword arguments."""
+        argument, args and kwargs as its arguments and keyword arguments.
+        
+        If the function was saved with prefetch=True, the datasets found in
+        its source are prefetched before each call.
+        
+        If the function was saved with a derived_groupname, its results are
+        stored in the file and reused for as long as they are up to date."""
         
         import functools
         
-        function_source = dataset.value
+        function_source = _dataset_value(dataset)
         function_docstring = dataset.docstring
         function_name = dataset.attrs['__h5scripting__function_name__']
         function_signature = dataset.attrs['__h5scripting__function_signature__']
         function_args = ast.literal_eval(dataset.attrs['__h5scripting__function_args__'])
         function_kwargs = ast.literal_eval(dataset.attrs['__h5scripting__function_kwargs__'])
+        functions_groupname = dataset.name.rsplit('/', 1)[0]
+        function_args = type(function_args)(_load_dataset_arguments(arg, functions_groupname)
+                                            for arg in function_args)
+        function_kwargs = dict((key, _load_dataset_arguments(value, functions_groupname))
+                               for key, value in function_kwargs.items())
+        if '__h5scripting__function_dataset_paths__' in dataset.attrs:
+            dataset_paths = ast.literal_eval(dataset.attrs['__h5scripting__function_dataset_paths__'])
+        else:
+            dataset_paths = []
+        prefetch = bool(dataset.attrs.get('__h5scripting__function_prefetch__', False))
+        derived_groupname = dataset.attrs.get('__h5scripting__function_derived_groupname__', None)
+        if '__h5scripting__function_depends_on__' in dataset.attrs:
+            depends_on = ast.literal_eval(dataset.attrs['__h5scripting__function_depends_on__'])
+        else:
+            depends_on = []
         
         # Exec the function definition to get the function object:
         sandbox_namespace = {}
@@ -523,7 +1749,15 @@ class SavedFunction(object):
         self.function_name = function_name
         self.function_args = function_args
         self.function_kwargs = function_kwargs
-        self.h5_filename = os.path.abspath(dataset.file.filename)
+        self.dataset_paths = dataset_paths
+        self.prefetch = prefetch
+        self.derived_groupname = derived_groupname
+        self.depends_on = depends_on
+        if filename is None:
+            filename = dataset.file.filename
+        self.h5_filename = os.path.abspath(filename)
+        self.profile = False
+        self.last_profile = None
         functools.update_wrapper(self, function)
         
     def __call__(self, *args, **kwargs):
@@ -539,7 +1773,33 @@ class SavedFunction(object):
         return self.custom_call(*self.function_args, **sandbox_kwargs)
             
     def custom_call(self, *args, **kwargs):
-        """Call the wrapped function with custom positional and keyword arguments."""
+        """Call the wrapped function with custom positional and keyword arguments.
+        
+        If the function was saved with a derived_groupname, the stored result
+        is returned instead when it is up to date.
+        
+        If the profile attribute is set to True, the call is profiled (see
+        save_profile) and the profile is saved next to the function."""
+        if self.derived_groupname is None:
+            return self._call(args, kwargs)
+
+        provenance = self._derived_provenance(args, kwargs)
+        try:
+            return self._load_derived(provenance)
+        except KeyError:
+            pass
+        result = self._call(args, kwargs)
+        self._save_derived(result, provenance)
+        return result
+
+    def _call(self, args, kwargs):
+        """Calls the wrapped function in an empty namespace"""
+        args = [arg.load(self.h5_filename) if isinstance(arg, DatasetArgument) else arg
+                for arg in args]
+        kwargs = dict((key, value.load(self.h5_filename) if isinstance(value, DatasetArgument) else value)
+                      for key, value in kwargs.items())
+        if self.prefetch:
+            prefetch_datasets(self.h5_filename, self.dataset_paths)
         # Names mangled to reduce risk of colliding with the function
         # attempting to access global variables (which it shouldn't be doing):
         sandbox_namespace = {'__h5s_filename': self.h5_filename,
@@ -547,9 +1807,147 @@ class SavedFunction(object):
                              '__h5s_args': args,
                              '__h5s_kwargs': kwargs}
         exc_line = '__h5s_result = __h5s_function(__h5s_filename, *__h5s_args, **__h5s_kwargs)'
-        exec_in_namespace(exc_line, sandbox_namespace)
+        if self.profile:
+            self.last_profile = _profile_call(lambda: exec_in_namespace(exc_line, sandbox_namespace))
+            self.save_profile(self.last_profile)
+        else:
+            exec_in_namespace(exc_line, sandbox_namespace)
         result = sandbox_namespace['__h5s_result']
         return result
+
+    def save_profile(self, profile):
+        """
+        Saves the profile of a call to the function as a dataset named after
+        the function with a '__profile' suffix, tagged 'function_profile',
+        next to it.  The dataset holds the cProfile statistics, and its
+        attributes the wall time, cpu time, peak memory and bytes read by
+        the calling thread (-1 if unknown) of the call, as measured by
+        _profile_call.  Any earlier profile is replaced.
+        """
+        import time
+
+        functions_groupname, name = self.name.rsplit('/', 1)
+        with File(self.h5_filename, 'a') as f:
+            grp = f.getitem(functions_groupname, h5scripting_id='functions_group')
+            dataset = grp.write_dataset(name + '__profile', data=profile['stats'],
+                                        docstring='profile of the last profiled call to %s'%name,
+                                        h5scripting_id='function_profile')
+            _write_attribute(dataset.attrs, '__h5scripting__profile_of__', name)
+            _write_attribute(dataset.attrs, '__h5scripting__profile_time__', time.time())
+            for key in ('wall_time', 'cpu_time', 'peak_memory', 'thread_bytes_read'):
+                _write_attribute(dataset.attrs, '__h5scripting__profile_%s__'%key, profile[key])
+
+    @property
+    def derived_path(self):
+        """The path of the group the results of this function are stored in"""
+        if self.derived_groupname is None:
+            return None
+        return self.derived_groupname.rstrip('/') + '/' + self.name.split('/')[-1]
+
+    def _derived_provenance(self, args, kwargs):
+        """
+        returns a dictionary of strings describing everything the result of
+        calling the function with args and kwargs depends on
+        """
+        input_stamps = {}
+        dependency_stamps = {}
+        with File(self.h5_filename, 'r') as f:
+            f._ErrorCheck = False
+            # Only this function's own results are not inputs; those of
+            # other functions are
+            derived_path = f[self.derived_path].name if self.derived_path in f else None
+            for path in self.dataset_paths:
+                try:
+                    obj = f[path]
+                except (KeyError, ValueError):
+                    continue
+                if not isinstance(obj, h5py.Dataset):
+                    continue
+                if derived_path is not None and obj.name.startswith(derived_path + '/'):
+                    continue
+                input_stamps[obj.name] = _dataset_stamp(obj)
+
+            for arg in list(args) + list(kwargs.values()):
+                if isinstance(arg, DatasetArgument):
+                    input_stamps[arg.path] = _dataset_stamp(f[arg.path])
+
+            # The results of a dependency are stamped by the hash of their
+            # provenance, or when they are not stored by the dependency's source
+            functions_groupname = self.name.rsplit('/', 1)[0]
+            for dependency in self.depends_on:
+                dataset = f[functions_groupname + '/' + dependency]
+                stamp = _source_hash(_dataset_value(dataset))
+                dependency_groupname = dataset.attrs.get('__h5scripting__function_derived_groupname__', None)
+                if dependency_groupname is not None:
+                    path = dependency_groupname.rstrip('/') + '/' + dependency
+                    if path in f:
+                        stamp = f[path].attrs.get('__h5scripting__derived_provenance_hash__', stamp)
+                dependency_stamps[dependency] = stamp
+
+        provenance = {'source_hash': _source_hash(self.function_source),
+                      'args': _argument_stamp(tuple(args)),
+                      'kwargs': _argument_stamp(dict(kwargs)),
+                      'input_stamps': repr(sorted(input_stamps.items())),
+                      'dependency_stamps': repr(sorted(dependency_stamps.items()))}
+        return provenance
+
+    def _load_derived(self, provenance):
+        """
+        returns the stored result of the function, raising a KeyError if
+        there is none or if its provenance does not match provenance
+        """
+        with File(self.h5_filename, 'r') as f:
+            if self.derived_path not in f:
+                raise KeyError(self.derived_path)
+            grp = f.getitem(self.derived_path, h5scripting_id='derived')
+            for key, value in provenance.items():
+                if grp.attrs.get('__h5scripting__derived_%s__'%key) != value:
+                    raise KeyError(self.derived_path)
+
+            result = {}
+            for key in grp:
+                result[key] = _dataset_value(grp.getitem(key, h5scripting_id='dataset'))
+
+            if grp.attrs['__h5scripting__derived_kind__'] == 'array':
+                result = result['result']
+        return result
+
+    def _save_derived(self, result, provenance):
+        """stores result in the file, along with its provenance"""
+        if isinstance(result, dict):
+            kind = 'dict'
+            data = result
+        else:
+            kind = 'array'
+            data = {'result': result}
+        for value in data.values():
+            if numpy.asarray(value).dtype.kind == 'O':
+                raise TypeError('results of functions saved with a derived_groupname ' +
+                                'must be arrays or dictionaries of arrays')
+
+        name = self.derived_path.split('/')[-1]
+        with File(self.h5_filename, 'a') as f:
+            parent = f.require_group(self.derived_groupname,
+                                     docstring='results derived by saved functions',
+                                     h5scripting_id='derived_group')
+            if name in parent:
+                try:
+                    parent.getitem(name, h5scripting_id='derived')
+                except TypeError:
+                    del parent[name]
+            grp = parent.require_group(name, docstring='results derived by %s'%self.name,
+                                       h5scripting_id='derived')
+            for key in list(grp):
+                if key not in data:
+                    del grp[key]
+            for key, value in data.items():
+                grp.write_dataset(key, data=value,
+                                  docstring='%s result derived by %s'%(key, self.name))
+            _write_attribute(grp.attrs, '__h5scripting__derived_kind__', kind)
+            for key, value in provenance.items():
+                _write_attribute(grp.attrs, '__h5scripting__derived_%s__'%key, value)
+            _write_attribute(grp.attrs, '__h5scripting__derived_provenance_hash__',
+                             _source_hash(repr(sorted(provenance.items()))))
         
     def __repr__(self):
         """A pretty representation of the object that displays all public attributes"""
@@ -576,9 +1974,12 @@ class SavedFunction(object):
                 '    function_kwargs=%s\n'%function_kwargs + 
                 '    h5_filename=%s>'%self.h5_filename)
                 
-    def do_all(self):
+    def do_all(self, profile=False):
         """
         evaluates the function and also plots relevant data
+
+        profile : if True, the call is profiled and the profile printed and
+            saved (see save_profile)
         """
         
         sep = "-"
@@ -593,7 +1994,17 @@ class SavedFunction(object):
         print(sep)
         print(self.function_source)
         print(sep)
-        self()
+        if profile:
+            self.profile, previous = True, self.profile
+            try:
+                self()
+            finally:
+                self.profile = previous
+            if self.last_profile is not None:
+                print(sep)
+                print(self.last_profile['stats'])
+        else:
+            self()
         print(sep + "\n")
 
         
@@ -621,7 +2032,7 @@ def get_saved_function(filename, name, groupname='saved_functions'):
     with File(filename, "r") as f:
         grp = f.getitem(groupname, h5scripting_id="functions_group")
         dataset = grp.getitem(name, h5scripting_id="function")
-        saved_function = SavedFunction(dataset)
+        saved_function = SavedFunction(dataset, filename)
     
     return saved_function
 
@@ -640,13 +2051,125 @@ def get_all_saved_functions(filename, groupname='saved_functions'):
     with File(filename, "r",) as f:
         grp = f.getitem(groupname, h5scripting_id="functions_group")
         
-        grp._ErrorCheck = False
-        for dataset in grp.values():
-            if dataset._check_h5scripting_id("function"):
-                saved_functions += [SavedFunction(dataset),]
+        for record in iter_tagged_objects(grp, "function", recursive=False):
+            dataset = grp.getitem(record.name, h5scripting_id="function")
+            saved_functions += [SavedFunction(dataset, filename),]
 
     return saved_functions
 
+def _run_saved_function(filename, name, groupname):
+    """
+    calls the saved function name with its saved arguments, without
+    consulting or storing derived results.  This is module level so that it
+    can be submitted to a process pool.
+    """
+    saved_function = get_saved_function(filename, name, groupname=groupname)
+    return saved_function._call(saved_function.function_args, saved_function.function_kwargs)
+
+
+def _dependency_waves(dependencies):
+    """
+    sorts the dependency graph {name: [names it depends on], } into a list of
+    waves [[name, ], ], where each name depends only on names in earlier waves
+    """
+    remaining = dict((name, set(depends_on)) for name, depends_on in dependencies.items())
+    waves = []
+    while remaining:
+        wave = sorted(name for name, depends_on in remaining.items() if not depends_on)
+        if not wave:
+            raise ValueError('Circular dependency between saved functions %s'%', '.join(sorted(remaining)))
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for depends_on in remaining.values():
+            depends_on.difference_update(wave)
+    return waves
+
+
+def run_saved_functions(filename, names=None, groupname='saved_functions', max_workers=None, executor=None):
+    """
+    Runs saved functions in the order given by their depends_on lists.
+    
+    Functions whose dependencies have all run are run in parallel, each with
+    its saved arguments and keyword arguments.  Functions saved with a
+    derived_groupname are skipped when their stored results are up to date,
+    so that after an input dataset changes only the functions affected by it
+    are recomputed.
+
+    filename : h5 file to use
+
+    names : list of the names of the saved functions to run.  The functions
+        they depend on are run as well.  Defaults to None, in which case all
+        saved functions in groupname are run.
+
+    groupname : the group in the h5 file the functions are saved to.
+        Defaults to 'saved_functions'
+
+    max_workers : number of threads to run functions in, defaults to that of
+        concurrent.futures.ThreadPoolExecutor
+
+    executor : a concurrent.futures.Executor to run functions in instead,
+        for example a ProcessPoolExecutor.  It is not shut down.
+    
+    returns : a dictionary such as {
+        "function1": result1,
+        ...}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    saved_functions = dict((saved_function.name.split('/')[-1], saved_function)
+                           for saved_function in get_all_saved_functions(filename, groupname=groupname))
+
+    if names is None:
+        names = list(saved_functions)
+    dependencies = {}
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in dependencies:
+            continue
+        if name not in saved_functions:
+            raise KeyError('No saved function %s in group %s'%(name, groupname))
+        dependencies[name] = saved_functions[name].depends_on
+        pending += saved_functions[name].depends_on
+    waves = _dependency_waves(dependencies)
+
+    if executor is None:
+        own_executor = executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        own_executor = None
+
+    results = {}
+    try:
+        for wave in waves:
+            # Only read from the file while functions are running; results
+            # are stored between waves
+            futures = {}
+            provenances = {}
+            for name in wave:
+                saved_function = saved_functions[name]
+                if saved_function.derived_groupname is not None:
+                    provenances[name] = saved_function._derived_provenance(saved_function.function_args,
+                                                                           saved_function.function_kwargs)
+                    try:
+                        results[name] = saved_function._load_derived(provenances[name])
+                        continue
+                    except KeyError:
+                        pass
+                futures[name] = executor.submit(_run_saved_function, saved_function.h5_filename, name, groupname)
+
+            for name, future in futures.items():
+                results[name] = future.result()
+            for name in futures:
+                if name in provenances:
+                    saved_functions[name]._save_derived(results[name], provenances[name])
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+
+    return results
+
+
 def list_all_saved_functions(filename, groupname='saved_functions'):
     """
     returns all the saved functions in the group deined by groupname as 
@@ -659,6 +2182,13 @@ def list_all_saved_functions(filename, groupname='saved_functions'):
     
     saved_functions = get_all_saved_functions(filename, groupname=groupname)
 
+    profiles = {}
+    with File(filename, "r") as f:
+        grp = f.getitem(groupname, h5scripting_id="functions_group")
+        for record in iter_tagged_objects(grp, "function_profile", recursive=False):
+            attrs = grp.getitem(record.name, h5scripting_id="function_profile").attrs
+            profiles[attrs['__h5scripting__profile_of__']] = dict(attrs)
+
     datalist = []
     for function in saved_functions:
         docstring = ""
@@ -668,6 +2198,16 @@ def list_all_saved_functions(filename, groupname='saved_functions'):
         docstring += "FUNCTION NAME: %s\n\n"%function.function_name
 
         docstring += "FUNCTION DOCSTRING:%s\n"%function.function_docstring
+
+        profile = profiles.get(function.name.split("/")[-1])
+        if profile is not None:
+            bytes_read = profile.get('__h5scripting__profile_thread_bytes_read__', -1)
+            docstring += ("FUNCTION PROFILE: wall time %.3g s, cpu time %.3g s, peak memory %d bytes, " +
+                          "thread bytes read %s (all files)\n")%(
+                profile['__h5scripting__profile_wall_time__'],
+                profile['__h5scripting__profile_cpu_time__'],
+                profile['__h5scripting__profile_peak_memory__'],
+                bytes_read if bytes_read >= 0 else "unknown")
         
                     
         docstring += "-------------------------------------------------"
@@ -677,13 +2217,149 @@ def list_all_saved_functions(filename, groupname='saved_functions'):
 
     return datalist
 
-def get_all_data(filename, groupname):
+def _unlink_shared_memory(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _close_shared_memory(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+class SharedArray(object):
+    """
+    A handle to a numpy array held in a multiprocessing.shared_memory block.
+    
+    Handles pickle to just the name, shape and dtype of the block, so they can
+    be passed to worker processes cheaply.  The array property attaches to the
+    block and returns a numpy view of it, without copying.
+    
+    The handle returned by SharedArray.create() owns the block, which is
+    unlinked when the owner is unlinked, garbage collected, or when the
+    interpreter exits.  Handles in worker processes only attach to it.
+    
+    Closing, unlinking or collecting a handle never unmaps the block: each
+    process keeps it mapped until the last numpy view of it is collected,
+    so views stay valid after their handle is gone.
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._shm = None
+        self._array = None
+        self._finalizer = None
+
+    @classmethod
+    def create(cls, shape, dtype):
+        """Allocates a new shared memory block and returns the owning handle"""
+        import weakref
+        from multiprocessing.shared_memory import SharedMemory
+
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape, dtype=numpy.int64)) * dtype.itemsize
+        # Zero sized blocks are not allowed
+        shm = SharedMemory(create=True, size=max(nbytes, 1))
+        handle = cls(shm.name, shape, dtype)
+        handle._shm = shm
+        handle._finalizer = weakref.finalize(handle, _unlink_shared_memory, shm)
+        return handle
+
+    @property
+    def owner(self):
+        return self._finalizer is not None and self._finalizer.alive
+
+    @property
+    def array(self):
+        """numpy view of the shared memory block"""
+        import weakref
+
+        if self._array is None:
+            if self._shm is None:
+                from multiprocessing.shared_memory import SharedMemory
+                try:
+                    self._shm = SharedMemory(name=self.name, track=False)
+                except TypeError:
+                    # Python < 3.13 has no track argument
+                    self._shm = SharedMemory(name=self.name)
+            self._array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+            # numpy does not hold on to the buffer it is given, so the block
+            # is only unmapped once this array, and so every view of it, has
+            # been collected.  Not at exit, when views may still be in use.
+            finalizer = weakref.finalize(self._array, _close_shared_memory, self._shm)
+            finalizer.atexit = False
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def close(self):
+        """
+        Detaches this handle from the block, without unlinking it.  Views
+        of the block taken before stay valid.
+        """
+        self._array = None
+        if not self.owner:
+            self._shm = None
+
+    def unlink(self):
+        """Releases the block.  Only the owning handle can do so."""
+        self._array = None
+        if self.owner:
+            self._finalizer()
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['shape'], state['dtype'])
+
+    def __repr__(self):
+        return '<%s: name=%s, shape=%s, dtype=%s>'%(self.__class__.__name__, self.name, self.shape, self.dtype)
+
+
+class SharedData(dict):
+    """
+    The dictionary returned by get_all_data(..., shared_memory=True).
+    
+    Numeric datasets are held as SharedArray handles, everything else as
+    ordinary values.  close() unlinks all of the shared memory blocks; this
+    is also done on leaving a with block.
+    """
+
+    def close(self):
+        for value in self.values():
+            if isinstance(value, SharedArray):
+                value.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_all_data(filename, groupname, shared_memory=False):
     """
     Gets data from an existing h5 file.
 
     filename : h5 file to use
 
     groupname : group to use
+
+    shared_memory : if True, numeric datasets are read directly into
+        multiprocessing.shared_memory blocks and returned as SharedArray
+        handles, which worker processes can attach to without copying.
+        The dictionary returned is then a SharedData, which should be
+        closed (or used in a with block) to release the blocks.
     
     only datasets with the "__h5scripting__" attribute set to 'dataset' are accepted
 
@@ -694,16 +2370,28 @@ def get_all_data(filename, groupname):
         where the names are the h5 dataset names.
     """
 
-    h5data = {}
+    if shared_memory:
+        h5data = SharedData()
+    else:
+        h5data = {}
     with File(filename, 'r') as f:
         grp = f[groupname]
 
         grp._ErrorCheck = False
-        for dataset in grp.values():
-            if dataset._check_h5scripting_id("dataset"):
-                key = dataset.name
-                key = key.split("/")[-1]
-                h5data[key] = dataset.value
+        try:
+            for record in iter_tagged_objects(grp, "dataset", recursive=False):
+                dataset = grp[record.name]
+                key = record.name
+                if shared_memory and record.dtype.kind in 'biufcmM' and record.shape is not None:
+                    handle = SharedArray.create(record.shape, record.dtype)
+                    dataset.read_direct(handle.array)
+                    h5data[key] = handle
+                else:
+                    h5data[key] = _dataset_value(dataset)
+        except BaseException:
+            if shared_memory:
+                h5data.close()
+            raise
 
     return h5data
 
@@ -739,46 +2427,427 @@ def list_all_saved_data(filename, groupname=None):
     the file to make it more simple to write functions.
     """
 
-    class cls(object):
-        """
-        provides a callable for grp.visititems to call
-        """
-        def __init__(self):
-            self.datalist = []
-        
-        def __call__(self, name, obj):
-            """
-            obj will either be a file, group, or dataset object
-            """
-            
-            if obj._check_h5scripting_id("group"):
-                docstring = ""
-    
-                # Build string for data in this group
-                docstring += "GROUP: %s\n\n"%name
-    
-                docstring += "GROUP DOCSTRING:%s\n"%(obj.attrs['__h5scripting__doc__'])
-                
-                # iterate over datasets in group
-                for dataset in obj.values():
-                    if dataset._check_h5scripting_id("dataset"):
-                        docstring += "DATASET %s: %s, %s\n"%(
-                            dataset.name.split("/")[-1],
-                            str(dataset.value.shape),
-                            str(dataset.value.dtype))
-                        docstring += "\t%s\n"%dataset.attrs['__h5scripting__doc__']
-                            
-                docstring += "-------------------------------------------------"
-    
-                self.datalist += [docstring,]
-
-    func = cls()
-
     with File(filename, "r") as f:
         f._ErrorCheck = False
         grp = f if groupname is None else f[groupname]
-        grp.visititems(func)
+        records = list(iter_tagged_objects(grp, ("group", "dataset")))
 
-    return func.datalist
-        
+    # datasets of each group, in the order visited
+    datasets = collections.defaultdict(list)
+    for record in records:
+        if record.type == "dataset" and record.h5scripting_id == "dataset":
+            datasets[record.path.rsplit("/", 1)[0]] += [record,]
+
+    datalist = []
+    for record in records:
+        if record.type == "group" and record.h5scripting_id == "group":
+            docstring = ""
+
+            # Build string for data in this group
+            docstring += "GROUP: %s\n\n"%record.name
+
+            docstring += "GROUP DOCSTRING:%s\n"%record.docstring
+
+            for dataset in datasets[record.path]:
+                docstring += "DATASET %s: %s, %s\n"%(
+                    dataset.name.split("/")[-1],
+                    str(dataset.shape),
+                    str(dataset.dtype))
+                docstring += "\t%s\n"%dataset.docstring
+
+            docstring += "-------------------------------------------------"
+
+            datalist += [docstring,]
+
+    return datalist
+
+def repack(filename, output=None):
+    """
+    Rewrites an h5 file without the free space left behind by deleted and
+    replaced objects, which HDF5 does not reclaim.
+
+    Every object is copied with all of its attributes, so all h5scripting
+    tags and docstrings are preserved, as are the root attributes and soft
+    and external links.
+
+    filename : h5 file to repack
+
+    output : file to write the repacked file to.  Defaults to None, in which
+        case filename is replaced with it.
+
+    returns a dictionary of the 'original_size' and 'repacked_size' of the
+        file in bytes, and the bytes 'recovered'
+    """
+    import tempfile
+
+    original_size = os.path.getsize(filename)
+    if output is None:
+        fd, target = tempfile.mkstemp(suffix='.h5', dir=os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+    else:
+        target = output
+
+    try:
+        with h5py.File(filename, 'r') as source, h5py.File(target, 'w') as destination:
+            for key in source.attrs:
+                destination.attrs.create(key, source.attrs[key], dtype=source.attrs.get_id(key).dtype)
+            for name in source:
+                link = source.get(name, getlink=True)
+                if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                    destination[name] = link
+                else:
+                    source.copy(name, destination, name=name)
+        repacked_size = os.path.getsize(target)
+        if output is None:
+            os.replace(target, filename)
+    except BaseException:
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+
+    if _file_images is not None:
+        _file_images.invalidate(filename)
+
+    return {'original_size': original_size,
+            'repacked_size': repacked_size,
+            'recovered': original_size - repacked_size}
+
+# -----------------------------------------------------------------------------
+#
+# START Merge service
+#
+# -----------------------------------------------------------------------------
+
+_MERGE_COUNTERS = ('submitted', 'written', 'rejected', 'bytes_written', 'batches', 'flushes', 'blocked_time',
+                   'failed')
+
+class _Counter(object):
+    """thread safe stand in for multiprocessing.Value"""
+    def __init__(self):
+        import threading
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
+
+
+def _write_merge_batch(f, items, chunk_rows):
+    """
+    writes a batch of ('write' or 'append', path, data, docstring) items to
+    the open file f, concatenating the appends to each dataset so that it is
+    resized and written once.  An item that cannot be written, or an append
+    that cannot be concatenated with the others to its dataset, does not
+    stop the rest of the batch.
+
+    returns the number of items and bytes written, and a list of messages
+    describing the items that could not be
+    """
+    def parent_group(path):
+        parentname, name = path.rsplit('/', 1) if '/' in path else ('/', path)
+        parentname = parentname or '/'
+        if parentname in f:
+            return f[parentname], name
+        return f.create_group(parentname, docstring='merged results'), name
+
+    def error(description, exception):
+        errors.append('%s: %s: %s'%(description, type(exception).__name__, exception))
+
+    def append(path):
+        rows, docstring = appends.pop(path)
+        try:
+            data = numpy.concatenate(rows)
+            grp, name = parent_group(path)
+            if name in grp:
+                dataset = grp[name]
+                length = dataset.shape[0]
+                dataset.resize(length + data.shape[0], axis=0)
+                dataset[length:] = data
+            else:
+                grp.create_dataset(name, data=data, docstring=docstring,
+                                   maxshape=(None,) + data.shape[1:],
+                                   chunks=(chunk_rows,) + data.shape[1:])
+        except Exception as exception:
+            error('appending %d submissions to %s'%(len(rows), path), exception)
+            return 0, 0
+        return len(rows), data.nbytes
+
+    def add(counts):
+        totals[0] += counts[0]
+        totals[1] += counts[1]
+
+    errors = []
+    totals = [0, 0]
+    appends = collections.OrderedDict()
+    for operation, path, data, docstring in items:
+        if operation == 'append':
+            appends.setdefault(path, ([], docstring))[0].append(data)
+        else:
+            # Keep the appends submitted before this write before it
+            if path in appends:
+                add(append(path))
+            try:
+                grp, name = parent_group(path)
+                grp.write_dataset(name, data=data, docstring=docstring)
+            except Exception as exception:
+                error('writing %s'%path, exception)
+            else:
+                add((1, data.nbytes))
+    while appends:
+        add(append(next(iter(appends))))
+    return totals[0], totals[1], errors
+
+
+def _merge_writer(filename, queue, errors, counters, batch_size, flush_interval, chunk_rows):
+    """
+    the loop of the single writer of a MergeService, which runs until it
+    receives None.  This is module level so that it can be a process target.
+    """
+    import time
+    import traceback
+    from queue import Empty
+
+    def add(key, value):
+        with counters[key].get_lock():
+            counters[key].value += value
+
+    try:
+        with File(filename, 'a') as f:
+            f._ErrorCheck = False
+            last_flush = time.time()
+            unflushed = False
+            done = False
+            while not done:
+                try:
+                    items = [queue.get(timeout=flush_interval)]
+                except Empty:
+                    items = []
+                while items and items[-1] is not None and len(items) < batch_size:
+                    try:
+                        items.append(queue.get_nowait())
+                    except Empty:
+                        break
+                if None in items:
+                    done = True
+                    items = items[:items.index(None)]
+
+                if items:
+                    written, bytes_written, messages = _write_merge_batch(f, items, chunk_rows)
+                    for message in messages:
+                        errors.put(message)
+                    unflushed = True
+                    add('written', written)
+                    add('rejected', len(items) - written)
+                    add('bytes_written', bytes_written)
+                    add('batches', 1)
+
+                if unflushed and (done or time.time() - last_flush >= flush_interval):
+                    f.flush()
+                    unflushed = False
+                    last_flush = time.time()
+                    add('flushes', 1)
+    except BaseException:
+        errors.put(traceback.format_exc())
+        add('failed', 1)
+
+
+class MergeService(object):
+    """
+    Merges results submitted by many workers into one summary h5 file, which
+    only the service writes to, as HDF5 does not support concurrent writers.
+
+    The writer runs in a separate process fed by a bounded queue.  It takes
+    up to batch_size submissions off the queue at a time, appending to
+    resizable chunked datasets with one resize and write per dataset per
+    batch, and flushes the file every flush_interval seconds.  When the
+    queue is full, submit() blocks, which pushes back on the workers.
+    Submissions the writer cannot write are counted as rejected and
+    reported by close(), without stopping it.
     
+    Worker processes must be given the service when they are started, for
+    example as an argument of multiprocessing.Process or of a Pool
+    initializer.  Use as a context manager, or call start() and close().
+
+    filename : the summary h5 file
+
+    max_queue_size : number of submissions the queue holds before submit()
+        blocks
+
+    batch_size : largest number of submissions written at once
+
+    flush_interval : seconds between flushes of the file
+
+    chunk_rows : number of rows per chunk of the datasets appended to
+    """
+
+    def __init__(self, filename, max_queue_size=1000, batch_size=100, flush_interval=1.0, chunk_rows=1024):
+        self.filename = os.path.abspath(filename)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.chunk_rows = chunk_rows
+        self._queue = self._make_queue(max_queue_size)
+        self._errors = self._make_queue(0)
+        self._counters = dict((key, self._make_counter()) for key in _MERGE_COUNTERS)
+        self._runner = None
+        self._start_time = None
+
+    def _make_queue(self, maxsize):
+        import multiprocessing
+        return multiprocessing.Queue(maxsize)
+
+    def _make_counter(self):
+        import multiprocessing
+        return multiprocessing.Value('d', 0.0)
+
+    def _make_runner(self, target, args):
+        import multiprocessing
+        return multiprocessing.Process(target=target, args=args, daemon=True)
+
+    def __getstate__(self):
+        # Workers only submit, so do not need the writer
+        state = self.__dict__.copy()
+        state['_runner'] = None
+        return state
+
+    def _add(self, key, value):
+        with self._counters[key].get_lock():
+            self._counters[key].value += value
+
+    def start(self):
+        """Starts the writer"""
+        import time
+
+        if self._runner is not None:
+            raise RuntimeError('%s already started'%self.__class__.__name__)
+        self._start_time = time.time()
+        self._runner = self._make_runner(_merge_writer,
+                                         (self.filename, self._queue, self._errors, self._counters,
+                                          self.batch_size, self.flush_interval, self.chunk_rows))
+        self._runner.start()
+
+    def submit(self, path, data, docstring="", append=False, block=True, timeout=None):
+        """
+        Queues a dataset write.
+
+        path : absolute path of the dataset in the summary file
+
+        data : the data to write.  If append is True this holds one or more
+            rows along its first axis, to be appended to the dataset;
+            otherwise it replaces the dataset.
+
+        docstring : docstring of the dataset, if it is created
+
+        block, timeout : if the queue is full, wait until there is space in
+            it (for at most timeout seconds if not None) when block is True,
+            and otherwise raise queue.Full immediately
+
+        Raises ValueError for appends of data without a first axis, and
+        TypeError for data HDF5 cannot store, without queueing it.
+        """
+        import time
+        from queue import Full
+
+        data = numpy.array(data)
+        if append and data.ndim < 1:
+            raise ValueError('Only data with at least one axis can be appended')
+        try:
+            h5py.h5t.py_create(data.dtype, logical=True)
+        except TypeError:
+            raise TypeError('Data of dtype %s cannot be stored in HDF5'%data.dtype)
+        item = ('append' if append else 'write', path, data, docstring)
+        start = time.time()
+        try:
+            while True:
+                if self._counters['failed'].value:
+                    raise RuntimeError('The writer of %s has failed, close it to see why'%self.__class__.__name__)
+                wait = 0.1
+                if timeout is not None:
+                    wait = min(wait, max(start + timeout - time.time(), 0))
+                try:
+                    self._queue.put(item, block, wait)
+                    break
+                except Full:
+                    if not block or (timeout is not None and time.time() >= start + timeout):
+                        raise
+        finally:
+            self._add('blocked_time', time.time() - start)
+        self._add('submitted', 1)
+
+    def metrics(self):
+        """
+        returns a dictionary of the service's metrics: the number of
+        submissions submitted, written, rejected by the writer (see close)
+        and pending; the number of batches
+        and flushes; bytes written; seconds submit() spent blocked; and the
+        throughput in submissions written per second since starting
+        """
+        import time
+
+        metrics = dict((key, self._counters[key].value) for key in _MERGE_COUNTERS if key != 'failed')
+        for key in ('submitted', 'written', 'rejected', 'bytes_written', 'batches', 'flushes'):
+            metrics[key] = int(metrics[key])
+        metrics['pending'] = metrics['submitted'] - metrics['written'] - metrics['rejected']
+        elapsed = time.time() - self._start_time if self._start_time is not None else 0
+        metrics['throughput'] = metrics['written'] / elapsed if elapsed > 0 else 0.0
+        return metrics
+
+    def close(self):
+        """
+        Writes everything submitted so far, flushes and closes the file, and
+        stops the writer.  Raises RuntimeError if the writer failed, or if
+        any submissions could not be written, describing why.
+        """
+        from queue import Full, Empty
+
+        if self._runner is not None:
+            while self._runner.is_alive():
+                try:
+                    self._queue.put(None, True, 0.1)
+                    break
+                except Full:
+                    pass
+            self._runner.join()
+            self._runner = None
+
+        messages = []
+        while True:
+            try:
+                messages.append(self._errors.get(True, 0.1))
+            except Empty:
+                break
+        if self._counters['failed'].value:
+            raise RuntimeError('The writer of %s failed:\n%s'%(self.__class__.__name__, '\n'.join(messages)))
+        if messages:
+            raise RuntimeError('%d submissions could not be written to %s:\n%s'%(
+                self._counters['rejected'].value, self.filename, '\n'.join(messages)))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InProcessMergeService(MergeService):
+    """
+    A MergeService whose writer is a thread of this process, for testing and
+    for workers that are threads.  It takes the same arguments.
+    """
+
+    def _make_queue(self, maxsize):
+        import queue
+        return queue.Queue(maxsize)
+
+    def _make_counter(self):
+        return _Counter()
+
+    def _make_runner(self, target, args):
+        import threading
+        return threading.Thread(target=target, args=args, daemon=True)
+
+# -----------------------------------------------------------------------------
+#
+# END Merge service
+#
+# -----------------------------------------------------------------------------
@@ -1,58 +1,822 @@
-from h5scripting import add_data, attached_function, get_saved_function, get_all_saved_functions
+"""
+Tests of h5scripting.  The test_* functions are run with pytest:
 
-from pylab import *
+    python -m pytest h5scripting/tests.py
 
-TEST_FILENAME = 'test.h5'
+Running this file as a script instead runs the interactive plotting demo at
+its end.
+"""
 
+import numpy
+import pytest
 
-x = linspace(0,10,1000)
-y = sin(x)
-some_global = 5
+from h5scripting import (File, attach_function, get_saved_function, find_dataset_paths,
+                         prefetch_datasets, run_saved_functions, get_all_data, SharedArray,
+                         iter_tagged_objects, list_all_saved_data, enable_file_images,
+                         disable_file_images, enable_slice_cache, disable_slice_cache,
+                         read_preview, add_pyramids, list_all_saved_functions, MergeService,
+                         InProcessMergeService, repack, build_pyramid)
 
 
-# make an h5 file to test on:
-add_data(TEST_FILENAME, 'data', dict(x=x, y=y))
-    
-    
-# Save a function to the h5 file (leaving default name and group kwargs).
-# This decorator modifies the function to receive the h5 filepath as its
-# first argument, and to execute in an empty namespace.
-@attached_function(TEST_FILENAME)
-def foo(h5_filepath, try_to_access_global=False, **kwargs):
+def make_data_file(filename):
+    """makes an h5scripting managed file with the datasets /data/x and /data/y"""
+    x = numpy.linspace(0, 10, 1000)
+    with File(filename, 'w') as f:
+        grp = f.create_group('data', docstring='test data')
+        grp.create_dataset('x', data=x)
+        grp.create_dataset('y', data=numpy.sin(x))
+    return filename
+
+
+def read_xy(h5_filepath):
+    import h5py
+    with h5py.File(h5_filepath, 'r') as f:
+        return f['data']['x'][:].sum() + f['/data/y'][:].sum()
+
+
+# -----------------------------------------------------------------------------
+# Prefetching the datasets a saved function reads
+# -----------------------------------------------------------------------------
+
+def test_find_dataset_paths():
+    source = ("def g(f, d):\n"
+              "    return f['data']['x'][:], f['/data/y'][0], d[key], f['a/']['b']\n")
+    assert find_dataset_paths(source) == ['/data/y', 'a/b', 'data/x']
+
+
+def test_prefetch_saved_function(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(read_xy, filename, prefetch=True)
+    assert saved.dataset_paths == ['/data/y', 'data/x']
+    expected = read_xy(filename)
+    assert saved() == expected
+
+    retrieved = get_saved_function(filename, 'read_xy')
+    assert retrieved.prefetch and retrieved.dataset_paths == saved.dataset_paths
+    assert retrieved() == expected
+
+
+def test_prefetch_datasets_ignores_missing_paths(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    assert prefetch_datasets(filename, ['/data/x', '/data', '/missing']) == 1000 * 8
+    assert prefetch_datasets(filename, ['/missing']) == 0
+
+
+# -----------------------------------------------------------------------------
+# Derived results cached with their provenance
+# -----------------------------------------------------------------------------
+
+def noisy_sum(h5_filepath, a):
+    import h5py
+    import numpy
+    with h5py.File(h5_filepath, 'r') as f:
+        x = f['/data/x'][:]
+    return {'total': numpy.array(x.sum() + numpy.sum(a)), 'noise': numpy.random.rand(3)}
+
+
+def test_derived_results_are_reused(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(noisy_sum, filename, args=[[1, 2]], derived_groupname='derived')
+    first = saved()
+    assert first['total'] == numpy.linspace(0, 10, 1000).sum() + 3
+    second = get_saved_function(filename, 'noisy_sum')()
+    assert numpy.array_equal(first['noise'], second['noise'])
+    with File(filename, 'r') as f:
+        assert f.getitem('derived', h5scripting_id='derived_group')
+
+
+def test_derived_results_recomputed_when_input_changes(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(noisy_sum, filename, args=[[1, 2]], derived_groupname='derived')
+    first = saved()
+    with File(filename, 'a') as f:
+        f['data/x'][0] = 100
+    second = saved()
+    assert second['total'] == first['total'] + 100
+    assert not numpy.array_equal(first['noise'], second['noise'])
+
+
+def test_derived_results_distinguish_large_arguments(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(noisy_sum, filename, args=[[1, 2]], derived_groupname='derived')
+    a = numpy.zeros(5000)
+    b = a.copy()
+    b[2500] = 1
+    assert saved.custom_call(b)['total'] == saved.custom_call(a)['total'] + 1
+
+
+def returns_none(h5_filepath):
+    return {'x': None}
+
+
+def test_derived_results_must_be_arrays(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(returns_none, filename, derived_groupname='derived')
+    with pytest.raises(TypeError):
+        saved()
+
+
+def produce(h5_filepath, k=2):
+    import numpy
+    return {'v': numpy.full(5, k)}
+
+
+def consume(h5_filepath):
+    import h5py
+    import numpy
+    with h5py.File(h5_filepath, 'r') as f:
+        v = f['/derived/produce/v'][:]
+    return {'total': numpy.array(v.sum()), 'noise': numpy.random.rand(3)}
+
+
+def test_derived_results_of_other_functions_are_inputs(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    producer = attach_function(produce, filename, derived_groupname='derived')
+    consumer = attach_function(consume, filename, derived_groupname='derived')
+    producer()
+    first = consumer()
+    assert first['total'] == 10
+    assert numpy.array_equal(consumer()['noise'], first['noise'])
+    producer.custom_call(k=5)
+    assert consumer()['total'] == 25
+
+
+# -----------------------------------------------------------------------------
+# Running saved functions as a dependency graph
+# -----------------------------------------------------------------------------
+
+def doubled(h5_filepath):
     import h5py
-    import pylab as pl
+    import numpy
     with h5py.File(h5_filepath, 'r') as f:
         x = f['/data/x'][:]
+    return {'v': 2 * x, 'noise': numpy.random.rand(3)}
+
+
+def doubled_total(h5_filepath):
+    import h5py
+    import numpy
+    with h5py.File(h5_filepath, 'r') as f:
+        v = f['/derived/doubled/v'][:]
+    return {'total': numpy.array(v.sum()), 'noise': numpy.random.rand(3)}
+
+
+def y_total(h5_filepath):
+    import h5py
+    import numpy
+    with h5py.File(h5_filepath, 'r') as f:
         y = f['/data/y'][:]
-    pl.xlabel('kwargs are: %s'%str(kwargs))
-    pl.plot(x, y)
-    if try_to_access_global:
-        print(some_global)
-    return True
-
-    
-# Test that we can call foo,
-# that it returns the right value,
-# and that we can show the plot:
-assert foo(x=5) == True
-show()
-clf()
-
-# Test we get an exception when trying
-# to access a global from foo:
-try:
-    foo(try_to_access_global=True)
-except NameError as e:
-    assert repr(e) in ["""NameError("name 'some_global' is not defined",)""",
-                       """NameError("global name 'some_global' is not defined",)"""]
-else:
-    raise AssertionError('should have gotten a name error')
- 
- 
-# Test that we can retrieve foo from the h5 file and call it
-retreived_foo = get_saved_function(TEST_FILENAME, 'foo')
-assert retreived_foo(x=5) == True
-show()
-
-import pprint
-pprint.pprint(get_all_saved_functions(TEST_FILENAME))
+    return {'total': numpy.array(y.sum()), 'noise': numpy.random.rand(3)}
+
+
+def make_graph_file(filename):
+    make_data_file(filename)
+    attach_function(doubled_total, filename, derived_groupname='derived', depends_on=['doubled'])
+    attach_function(doubled, filename, derived_groupname='derived')
+    attach_function(y_total, filename, derived_groupname='derived')
+    return filename
+
+
+def test_run_saved_functions_in_dependency_order(tmp_path):
+    filename = make_graph_file(str(tmp_path / 'test.h5'))
+    results = run_saved_functions(filename, names=['doubled_total'])
+    assert sorted(results) == ['doubled', 'doubled_total']
+    assert results['doubled_total']['total'] == 2 * numpy.linspace(0, 10, 1000).sum()
+
+
+def test_run_saved_functions_recomputes_only_what_changed(tmp_path):
+    filename = make_graph_file(str(tmp_path / 'test.h5'))
+    first = run_saved_functions(filename)
+    unchanged = run_saved_functions(filename)
+    for name in first:
+        assert numpy.array_equal(first[name]['noise'], unchanged[name]['noise'])
+
+    with File(filename, 'a') as f:
+        f['data/x'][0] = 100
+    second = run_saved_functions(filename, max_workers=2)
+    assert second['doubled_total']['total'] == first['doubled_total']['total'] + 200
+    assert not numpy.array_equal(first['doubled']['noise'], second['doubled']['noise'])
+    assert not numpy.array_equal(first['doubled_total']['noise'], second['doubled_total']['noise'])
+    assert numpy.array_equal(first['y_total']['noise'], second['y_total']['noise'])
+
+
+def test_run_saved_functions_errors(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    attach_function(doubled, filename, depends_on=['doubled_total'])
+    attach_function(doubled_total, filename, depends_on=['doubled'])
+    with pytest.raises(ValueError):
+        run_saved_functions(filename)
+    with pytest.raises(KeyError):
+        run_saved_functions(filename, names=['missing'])
+
+
+# -----------------------------------------------------------------------------
+# Loading data into shared memory
+# -----------------------------------------------------------------------------
+
+def shared_sum(handle):
+    return float(numpy.asarray(handle).sum())
+
+
+def test_get_all_data(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    data = get_all_data(filename, 'data')
+    assert sorted(data) == ['x', 'y']
+    assert numpy.array_equal(data['x'], numpy.linspace(0, 10, 1000))
+
+
+def test_get_all_data_in_shared_memory(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    with get_all_data(filename, 'data', shared_memory=True) as data:
+        assert isinstance(data['x'], SharedArray) and data['x'].owner
+        assert numpy.array_equal(data['x'], numpy.linspace(0, 10, 1000))
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(shared_sum, data['x']).result() == pytest.approx(5000)
+
+
+SHARED_VIEWS_OUTLIVE_HANDLES = """
+import gc, pickle, sys
+import numpy
+from h5scripting import get_all_data
+
+x = numpy.linspace(0, 10, 1000)
+views = []
+data = get_all_data(sys.argv[1], 'data', shared_memory=True)
+views.append(numpy.asarray(data['x'])[::2])
+del data
+gc.collect()
+
+data = get_all_data(sys.argv[1], 'data', shared_memory=True)
+views.append(numpy.asarray(data['x']))
+attached = pickle.loads(pickle.dumps(data['x']))
+views.append(attached.array)
+attached.close()
+data.close()
+del attached, data
+gc.collect()
+
+assert numpy.array_equal(views[0], x[::2])
+assert numpy.array_equal(views[1], x)
+assert numpy.array_equal(views[2], x)
+"""
+
+
+def test_shared_memory_views_outlive_their_handles(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    # Reading an unmapped view crashes the interpreter, so this runs apart
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-c', SHARED_VIEWS_OUTLIVE_HANDLES, filename],
+                             cwd=package_dir, capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr
+
+
+# -----------------------------------------------------------------------------
+# Low level traversal of tagged objects
+# -----------------------------------------------------------------------------
+
+def make_tree_file(filename):
+    import h5py
+
+    make_data_file(filename)
+    with File(filename, 'a') as f:
+        grp = f.create_group('data/nested', docstring='nested group')
+        grp.create_dataset('z', data=numpy.arange(6).reshape(2, 3), docstring='z data')
+    with h5py.File(filename, 'a') as f:
+        f['data/untagged'] = numpy.arange(3)
+        f['data/dangling'] = h5py.SoftLink('/missing')
+    return filename
+
+
+def test_iter_tagged_objects(tmp_path):
+    import h5py
+
+    filename = make_tree_file(str(tmp_path / 'test.h5'))
+    with h5py.File(filename, 'r') as f:
+        records = dict((record.path, record) for record in iter_tagged_objects(f))
+        assert sorted(records) == ['/data', '/data/nested', '/data/nested/z', '/data/x', '/data/y']
+        z = records['/data/nested/z']
+        assert (z.name, z.type, z.h5scripting_id, z.docstring) == ('data/nested/z', 'dataset', 'dataset', 'z data')
+        assert z.shape == (2, 3) and z.dtype == numpy.arange(6).dtype
+        assert records['/data'].shape is None and records['/data'].docstring == 'test data'
+
+        members = list(iter_tagged_objects(f['data'], 'dataset', recursive=False))
+        assert sorted(record.name for record in members) == ['x', 'y']
+        assert list(iter_tagged_objects(f['data'], 'function')) == []
+
+
+def test_list_all_saved_data(tmp_path):
+    filename = make_tree_file(str(tmp_path / 'test.h5'))
+    listing = list_all_saved_data(filename)
+    assert [entry.splitlines()[0] for entry in listing] == ['GROUP: data', 'GROUP: data/nested']
+    assert 'DATASET x: (1000,), float64' in listing[0]
+    assert 'untagged' not in listing[0] and 'dangling' not in listing[0]
+    assert 'DATASET z: (2, 3)' in list_all_saved_data(filename, 'data')[0]
+
+
+# -----------------------------------------------------------------------------
+# In-memory file images
+# -----------------------------------------------------------------------------
+
+def test_file_images_serve_repeated_reads(tmp_path):
+    import h5py
+
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    cache = enable_file_images()
+    try:
+        for i in range(3):
+            with File(filename, 'r') as f:
+                assert numpy.array_equal(f['data/x'][:], numpy.linspace(0, 10, 1000))
+        assert (cache.stats()['hits'], cache.stats()['misses']) == (2, 1)
+
+        # Changing the file on disk invalidates its image
+        with h5py.File(filename, 'a') as f:
+            f['data/x'][0] = 100
+        with File(filename, 'r') as f:
+            assert f['data/x'][0] == 100
+        assert cache.stats()['misses'] == 2
+    finally:
+        disable_file_images()
+
+
+def test_file_images_write_back(tmp_path):
+    import h5py
+
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    cache = enable_file_images()
+    try:
+        with File(filename, 'r') as f:
+            f['data/x'][:]
+        with File(filename, 'a') as f:
+            f['data'].create_dataset('z', data=numpy.arange(3))
+        assert cache.stats()['files'] == 0
+        with File(filename, 'r') as f:
+            assert numpy.array_equal(f['data/z'][:], numpy.arange(3))
+    finally:
+        disable_file_images()
+    with h5py.File(filename, 'r') as f:
+        assert numpy.array_equal(f['data/z'][:], numpy.arange(3))
+
+
+def test_file_images_skip_large_files(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    cache = enable_file_images(max_file_size=1024)
+    try:
+        with File(filename, 'r') as f:
+            f['data/x'][:]
+        assert cache.stats()['files'] == 0 and cache.stats()['misses'] == 0
+    finally:
+        disable_file_images()
+
+
+# -----------------------------------------------------------------------------
+# Slice cache
+# -----------------------------------------------------------------------------
+
+def test_slice_cache(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    cache = enable_slice_cache()
+    try:
+        with File(filename, 'r') as f:
+            first = f['data/x'][:10]
+            first[0] = 100
+            assert f['data/x'][:10][0] == 0
+            f['data/x'][f['data/x'][:] > 5]
+        with File(filename, 'r') as f:
+            assert numpy.array_equal(f['data/x'][:10], numpy.linspace(0, 10, 1000)[:10])
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses']) == (2, 3)
+
+        # Writes through h5scripting drop the cached slices
+        with File(filename, 'a') as f:
+            f['data/x'][:10] = 100
+            assert numpy.all(f['data/x'][:10] == 100)
+    finally:
+        disable_slice_cache()
+
+
+def test_slice_cache_with_file_images(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    cache = enable_slice_cache()
+    enable_file_images()
+    try:
+        for i in range(3):
+            with File(filename, 'r') as f:
+                f['data/x'][:10]
+        assert (cache.stats()['hits'], cache.stats()['misses']) == (2, 1)
+    finally:
+        disable_file_images()
+        disable_slice_cache()
+
+
+# -----------------------------------------------------------------------------
+# Preview pyramids
+# -----------------------------------------------------------------------------
+
+def test_pyramid_previews(tmp_path):
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        dset = f.create_dataset('trace', data=numpy.arange(10000.), pyramid=True)
+        assert f.getitem('trace_pyramid', h5scripting_id='pyramid')
+
+        preview = dset.preview(100)
+        assert preview.step == 16 and preview.min.shape == (625,)
+        assert (preview.min[1], preview.max[1], preview.mean[1]) == (16, 31, 23.5)
+
+        preview = read_preview(dset, 100, slice(1600, 3200))
+        assert preview.step == 16 and preview.min[0] == 1600
+
+        preview = dset.preview(5000)
+        assert preview.step == 1 and numpy.array_equal(preview.mean, numpy.arange(10000.))
+
+
+def test_add_pyramids(tmp_path):
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.create_dataset('image', data=numpy.ones((2048, 100), dtype='i2'))
+        f.create_dataset('small', data=numpy.ones(100))
+    assert add_pyramids(filename, min_size=1000) == ['/image']
+    with File(filename, 'r') as f:
+        preview = f['image'].preview(10)
+        assert preview.step == 4 and preview.mean.shape == (512, 25)
+        assert numpy.all(preview.mean == 1)
+
+
+def test_pyramid_rejected_before_creating_dataset(tmp_path):
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        with pytest.raises(TypeError):
+            f.create_dataset('text', data=numpy.array(['a', 'b'], dtype='S1'), pyramid=True)
+        with pytest.raises(TypeError):
+            f.create_dataset('cube', shape=(4, 4, 4), pyramid=True)
+        with pytest.raises(ValueError):
+            f.create_dataset(None, data=numpy.arange(10.), pyramid=True)
+        assert list(f) == []
+
+
+def test_pyramid_dropped_when_dataset_written(tmp_path):
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.create_dataset('trace', data=numpy.arange(10000.), pyramid=True)
+        f.write_dataset('trace', numpy.zeros(10000))
+        assert 'trace_pyramid' not in f
+        assert f['trace'].preview(100).max.max() == 0
+
+        f.create_dataset('other', data=numpy.arange(10000.), pyramid=True)
+        f['other'][:10] = -1
+        assert 'other_pyramid' not in f and f['other'].preview(100).min.min() == -1
+
+        build_pyramid(f['trace'])
+        f.write_dataset('trace', numpy.zeros(500))
+        assert 'trace_pyramid' not in f
+        preview = f['trace'].preview(10)
+        assert preview.step == 1 and preview.mean.shape == (500,)
+
+
+def test_pyramid_ignored_when_dataset_replaced_by_other_means(tmp_path):
+    import h5py
+
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.create_dataset('trace', data=numpy.arange(10000.), pyramid=True)
+    with h5py.File(filename, 'a') as f:
+        del f['trace']
+        f['trace'] = numpy.zeros(5000)
+        assert 'trace_pyramid' in f
+        preview = read_preview(f['trace'], 100)
+        assert preview.step == 1 and preview.max.max() == 0
+
+
+# -----------------------------------------------------------------------------
+# Large arguments of saved functions saved as datasets
+# -----------------------------------------------------------------------------
+
+def describe_arguments(h5_filepath, a, b, c=None):
+    return (type(a).__name__, [type(item).__name__ for item in b[:2]], a[-1], b[-1], type(c).__name__)
+
+
+def test_large_arguments_saved_as_datasets(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    a = numpy.arange(5000.)
+    b = list(range(2000))
+    c = tuple(float(i) for i in range(1000))
+    saved = attach_function(describe_arguments, filename, args=[a, b], kwargs={'c': c})
+    expected = ('ndarray', ['int', 'int'], 4999., 1999, 'tuple')
+    assert saved() == expected
+    assert get_saved_function(filename, 'describe_arguments')() == expected
+    with File(filename, 'r') as f:
+        records = iter_tagged_objects(f.getitem('saved_functions', 'functions_group'), 'function_argument')
+        assert sorted(record.name for record in records) == ['describe_arguments__arg_0',
+                                                              'describe_arguments__arg_1',
+                                                              'describe_arguments__kwarg_c']
+
+    # Arguments the function no longer has are deleted
+    attach_function(describe_arguments, filename, args=[[1.], [2]])
+    with File(filename, 'r') as f:
+        assert list(iter_tagged_objects(f.getitem('saved_functions', 'functions_group'), 'function_argument')) == []
+
+
+def test_unstorable_array_arguments_rejected(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    attach_function(describe_arguments, filename, args=[numpy.arange(2000.), [0]])
+    with pytest.raises(ValueError):
+        attach_function(describe_arguments, filename, args=[numpy.array(['a', 'b']), [0]])
+    with pytest.raises(ValueError):
+        attach_function(describe_arguments, filename, args=[numpy.array([None, 1]), [0]])
+    with pytest.raises(TypeError):
+        attach_function(describe_arguments, filename, args=[[0], [0]], kwargs={'c': numpy.array(['a'])})
+    assert get_saved_function(filename, 'describe_arguments')()[2] == 1999.
+
+
+def test_mixed_number_lists_saved_as_literals(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    b = [1.5] + list(range(1999))
+    attach_function(describe_arguments, filename, args=[[0], b])
+    assert get_saved_function(filename, 'describe_arguments')() == ('list', ['float', 'int'], 0, 1998, 'NoneType')
+    with File(filename, 'r') as f:
+        assert list(iter_tagged_objects(f.getitem('saved_functions', 'functions_group'), 'function_argument')) == []
+
+
+# -----------------------------------------------------------------------------
+# Profiling saved functions
+# -----------------------------------------------------------------------------
+
+def profile_records(filename):
+    with File(filename, 'r') as f:
+        return [record.name for record in
+                iter_tagged_objects(f.getitem('saved_functions', 'functions_group'), 'function_profile')]
+
+
+def test_profile_saved_function(tmp_path, capsys):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(read_xy, filename)
+    saved.profile = True
+    assert saved() == read_xy(filename)
+    profile = saved.last_profile
+    assert profile['wall_time'] >= 0 and profile['cpu_time'] >= 0 and profile['peak_memory'] >= 0
+    assert 'read_xy' in profile['stats']
+    assert profile_records(filename) == ['read_xy__profile']
+    assert 'FUNCTION PROFILE: wall time' in list_all_saved_functions(filename)[0]
+
+    retrieved = get_saved_function(filename, 'read_xy')
+    retrieved.do_all(profile=True)
+    assert 'function calls' in capsys.readouterr().out
+    assert not retrieved.profile
+
+
+def sleep_briefly(h5_filepath):
+    import time
+    time.sleep(0.5)
+
+
+def test_profile_counts_reads_of_the_calling_thread_only(tmp_path):
+    import sys
+    import threading
+
+    if not sys.platform.startswith('linux'):
+        pytest.skip('bytes read are only measured on Linux')
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    other = tmp_path / 'other.bin'
+    other.write_bytes(b'\0' * 2**24)
+
+    saved = attach_function(sleep_briefly, filename)
+    saved.profile = True
+    reader = threading.Thread(target=other.read_bytes)
+    reader.start()
+    saved()
+    reader.join()
+    assert 0 <= saved.last_profile['thread_bytes_read'] < 2**20
+    assert 'thread bytes read' in list_all_saved_functions(filename)[0]
+
+
+def test_profile_dropped_when_source_changes(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    saved = attach_function(read_xy, filename)
+    saved.profile = True
+    saved()
+    attach_function(read_xy, filename, kwargs={})
+    assert profile_records(filename) == ['read_xy__profile']
+    attach_function(doubled, filename, name='read_xy')
+    assert profile_records(filename) == []
+    assert 'FUNCTION PROFILE' not in list_all_saved_functions(filename)[0]
+
+
+# -----------------------------------------------------------------------------
+# Merge service
+# -----------------------------------------------------------------------------
+
+def submit_shot(service, shot):
+    service.submit('/shots/counts', numpy.full((2, 3), shot), append=True)
+    service.submit('/shots/last', numpy.array(shot))
+
+
+def test_merge_service_in_process(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    filename = str(tmp_path / 'summary.h5')
+    with InProcessMergeService(filename, max_queue_size=4, batch_size=3, flush_interval=0.05) as service:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda shot: submit_shot(service, shot), range(20)))
+    metrics = service.metrics()
+    assert metrics['submitted'] == metrics['written'] == 40 and metrics['pending'] == 0
+    assert metrics['batches'] >= 14 and metrics['flushes'] >= 1
+    with File(filename, 'r') as f:
+        counts = f['shots/counts'][:]
+        assert counts.shape == (40, 3)
+        assert sorted(counts[::2, 0]) == list(range(20))
+        assert f['shots/last'].shape == ()
+
+
+def test_merge_service_processes(tmp_path):
+    import multiprocessing
+
+    filename = str(tmp_path / 'summary.h5')
+    with MergeService(filename, chunk_rows=8) as service:
+        workers = [multiprocessing.Process(target=submit_shot, args=(service, shot)) for shot in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    assert service.metrics()['written'] == 8
+    with File(filename, 'r') as f:
+        assert sorted(f['shots/counts'][::2, 0]) == [0, 1, 2, 3]
+
+
+def test_merge_service_rejects_bad_submissions(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    service = InProcessMergeService(filename, batch_size=10, flush_interval=0.05)
+    with pytest.raises(ValueError):
+        service.submit('/a/bad', 5, append=True)
+    with pytest.raises(TypeError):
+        service.submit('/a/text', numpy.array(['a', 'b']))
+
+    # /data is a group, and rows of different widths cannot be concatenated.
+    # These are submitted before starting so that they make up one batch.
+    service.submit('/data', numpy.arange(3))
+    service.submit('/a/rows', numpy.zeros((1, 2)), append=True)
+    service.submit('/a/rows', numpy.zeros((1, 3)), append=True)
+    service.submit('/a/good', numpy.arange(3))
+    service.start()
+    with pytest.raises(RuntimeError) as error:
+        service.close()
+    assert '/data' in str(error.value) and '/a/rows' in str(error.value)
+    metrics = service.metrics()
+    assert (metrics['written'], metrics['rejected'], metrics['pending']) == (1, 3, 0)
+    with File(filename, 'r') as f:
+        assert numpy.array_equal(f['a/good'][()], numpy.arange(3))
+
+
+def test_merge_service_writer_failure(tmp_path):
+    service = InProcessMergeService(str(tmp_path / 'missing' / 'summary.h5'), flush_interval=0.05)
+    service.start()
+    service._runner.join()
+    with pytest.raises(RuntimeError):
+        service.submit('/a', numpy.arange(3))
+    with pytest.raises(RuntimeError):
+        service.close()
+
+
+# -----------------------------------------------------------------------------
+# Overwriting in place and repacking
+# -----------------------------------------------------------------------------
+
+def test_write_dataset_in_place(tmp_path):
+    import os
+
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.write_dataset('x', numpy.arange(5.), docstring='first')
+        f.write_dataset('text', 'some text')
+    size = os.path.getsize(filename)
+    for i in range(20):
+        with File(filename, 'a') as f:
+            f.write_dataset('x', numpy.arange(5.) + i, docstring='version %d'%i)
+            f.write_dataset('text', 'some text %d'%(i % 2))
+    assert os.path.getsize(filename) == size
+    with File(filename, 'r') as f:
+        assert numpy.array_equal(f['x'][()], numpy.arange(5.) + 19)
+        assert f['x'].docstring == 'version 19'
+
+
+def test_write_dataset_sees_other_writes(tmp_path):
+    import h5py
+
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.write_dataset('x', numpy.arange(5.))
+        f['x'][0] = 99
+        f.write_dataset('x', numpy.arange(5.))
+        assert f['x'][0] == 0
+    with h5py.File(filename, 'a') as f:
+        f['x'][0] = 99
+    with File(filename, 'a') as f:
+        f.write_dataset('x', numpy.arange(5.))
+        assert f['x'][0] == 0
+
+        # Data of another shape replaces the dataset
+        f.write_dataset('x', numpy.arange(3))
+        assert numpy.array_equal(f['x'][()], numpy.arange(3))
+        # An object with another tag is not overwritten
+        f.create_group('grp').write_dataset('inner', numpy.arange(3), h5scripting_id='function')
+        with pytest.raises(TypeError):
+            f['grp'].write_dataset('inner', numpy.arange(3), h5scripting_id='function_argument')
+
+
+def test_attributes_rewritten_with_their_new_type(tmp_path):
+    import h5py
+    from h5scripting.h5scripting import _write_attribute
+
+    filename = str(tmp_path / 'test.h5')
+    with File(filename, 'w') as f:
+        f.create_group('grp', docstring='old')
+    with h5py.File(filename, 'a') as f:
+        # A fixed length string, as written by older h5py or other tools
+        f['grp'].attrs['__h5scripting__doc__'] = numpy.bytes_('old')
+        f['grp'].attrs['count'] = 2
+    with File(filename, 'a') as f:
+        grp = f.require_group('grp', docstring='a much longer docstring')
+        _write_attribute(grp.attrs, 'count', 2.5)
+        _write_attribute(grp.attrs, 'count', 3.5)
+    with File(filename, 'r') as f:
+        assert f['grp'].docstring == 'a much longer docstring'
+        assert f['grp'].attrs['count'] == 3.5
+
+
+def test_repack(tmp_path):
+    filename = make_data_file(str(tmp_path / 'test.h5'))
+    with File(filename, 'a') as f:
+        f['data'].create_dataset('big', data=numpy.zeros(100000), docstring='big data')
+    attach_function(read_xy, filename)
+    with File(filename, 'a') as f:
+        del f['data/big']
+    result = repack(filename)
+    assert result['recovered'] > 100000 * 8 * 0.9
+    assert result['repacked_size'] == result['original_size'] - result['recovered']
+    with File(filename, 'r') as f:
+        assert f['data'].docstring == 'test data' and 'big' not in f['data']
+    assert get_saved_function(filename, 'read_xy')() == read_xy(filename)
+
+
+if __name__ == '__main__':
+    from h5scripting import attached_function, get_all_saved_functions
+
+    from pylab import *
+
+    TEST_FILENAME = 'test.h5'
+
+
+    some_global = 5
+
+
+    # make an h5 file to test on:
+    make_data_file(TEST_FILENAME)
+
+
+    # Save a function to the h5 file (leaving default name and group kwargs).
+    # This decorator modifies the function to receive the h5 filepath as its
+    # first argument, and to execute in an empty namespace.
+    @attached_function(TEST_FILENAME)
+    def foo(h5_filepath, try_to_access_global=False, **kwargs):
+        import h5py
+        import pylab as pl
+        with h5py.File(h5_filepath, 'r') as f:
+            x = f['/data/x'][:]
+            y = f['/data/y'][:]
+        pl.xlabel('kwargs are: %s'%str(kwargs))
+        pl.plot(x, y)
+        if try_to_access_global:
+            print(some_global)
+        return True
+
+
+    # Test that we can call foo,
+    # that it returns the right value,
+    # and that we can show the plot:
+    assert foo(x=5) == True
+    show()
+    clf()
+
+    # Test we get an exception when trying
+    # to access a global from foo:
+    try:
+        foo(try_to_access_global=True)
+    except NameError as e:
+        assert repr(e) in ["""NameError("name 'some_global' is not defined",)""",
+                           """NameError("name 'some_global' is not defined")""",
+                           """NameError("global name 'some_global' is not defined",)"""]
+    else:
+        raise AssertionError('should have gotten a name error')
+
+
+    # Test that we can retrieve foo from the h5 file and call it
+    retreived_foo = get_saved_function(TEST_FILENAME, 'foo')
+    assert retreived_foo(x=5) == True
+    show()
+
+    import pprint
+    pprint.pprint(get_all_saved_functions(TEST_FILENAME))